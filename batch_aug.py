@@ -0,0 +1,140 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils import data
+
+
+def window_size(crop_size, min_scale):
+    """ side of the raw window that still covers a crop at the smallest scale
+    """
+    return int(math.ceil(crop_size / min_scale))
+
+
+class RawCropDataset(data.Dataset):
+    """Worker stage of the batched pipeline: decode a sample to uint8 tensors
+    and cut a random ``window`` x ``window`` region, padding images with 0 and
+    labels with 255. Every sample has the same shape, so batches collate
+    without any per-sample resampling; BatchAugment does the rest. Samples are
+    (image, label, size), size being the (h, w) of the image part of the
+    window, at its top-left.
+
+    ``dataset`` is a VOCSegmentation or Cityscapes instance, or a
+    MemmapSegmentation whose ``load`` skips decoding.
+    """
+    def __init__(self, dataset, window, ignore_index=255):
+        self.dataset = dataset
+        self.window = window
+        self.ignore_index = ignore_index
+        self.encode_target = getattr(dataset, 'encode_target', None)
+        self.decode_target = dataset.decode_target
+
+    def load(self, index):
+        if hasattr(self.dataset, 'load'):
+            return self.dataset.load(index)
+        labels = self.dataset.masks if hasattr(self.dataset, 'masks') else self.dataset.targets
+        img = np.asarray(Image.open(self.dataset.images[index]).convert('RGB'), dtype=np.uint8)
+        lbl = np.asarray(Image.open(labels[index]), dtype=np.uint8)
+        return img, lbl
+
+    def __getitem__(self, index):
+        img, lbl = self.load(index)
+        if self.encode_target is not None:
+            lbl = self.encode_target(lbl)
+        img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+        lbl = torch.from_numpy(np.asarray(lbl, dtype=np.uint8))
+
+        h, w = lbl.shape
+        y = int(torch.randint(0, max(h - self.window, 0) + 1, (1,)))
+        x = int(torch.randint(0, max(w - self.window, 0) + 1, (1,)))
+        img_out = img.new_zeros((3, self.window, self.window))
+        lbl_out = lbl.new_full((self.window, self.window), self.ignore_index)
+        crop_h, crop_w = min(h, self.window), min(w, self.window)
+        img_out[:, :crop_h, :crop_w] = img[:, y:y+crop_h, x:x+crop_w]
+        lbl_out[:crop_h, :crop_w] = lbl[y:y+crop_h, x:x+crop_w]
+        return img_out, lbl_out, torch.tensor([crop_h, crop_w])
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def _blend(img, other, factor):
+    return (factor * img + (1 - factor) * other).clamp_(0, 1)
+
+
+class BatchAugment(object):
+    """Random scale, crop, horizontal flip, color jitter and normalization of a
+    whole uint8 batch on its device.
+
+    Scale, crop and flip are one affine resampling per sample through
+    ``F.grid_sample``: bilinear for images, nearest for labels, so both stay
+    aligned. As with ExtRandomScale + ExtRandomCrop(pad_if_needed), a crop
+    lies inside the scaled image when that is at least the crop size, and is
+    centred on it with padding (0 for images, ``ignore_index`` for labels)
+    otherwise. Jitter follows ExtColorJitter's brightness/contrast/saturation
+    ranges in a fixed order. Random parameters are drawn from a CPU generator
+    seeded with ``seed``, which makes runs reproducible on any device.
+    """
+    def __init__(self, crop_size, scale_range=(1.0, 1.0), hflip=True, jitter=None,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), seed=0, ignore_index=255):
+        self.crop_size = crop_size
+        self.ignore_index = ignore_index
+        self.scale_range = scale_range
+        self.hflip = hflip
+        self.jitter = jitter
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def uniform(self, n, lo, hi):
+        return torch.rand(n, generator=self.generator) * (hi - lo) + lo
+
+    def __call__(self, images, labels, sizes):
+        """ images, labels and sizes as collated from RawCropDataset
+        """
+        N, _, S, _ = images.shape
+        device = images.device
+        extent = self.crop_size / self.uniform(N, *self.scale_range)  # crop side in window pixels
+        side = extent / S  # and as a fraction of the window
+
+        def centre(valid):
+            room = valid.float() - extent
+            start = torch.where(room >= 0, self.uniform(N, 0, 1) * room, room / 2)
+            return (2 * start + extent) / S - 1  # in grid coordinates, [-1, 1] across the window
+
+        cy = centre(sizes[:, 0])
+        cx = centre(sizes[:, 1])
+        flip = torch.ones(N)
+        if self.hflip:
+            flip[torch.rand(N, generator=self.generator) < 0.5] = -1
+
+        theta = torch.zeros(N, 2, 3)
+        theta[:, 0, 0] = side * flip
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = side
+        theta[:, 1, 2] = cy
+        grid = F.affine_grid(theta.to(device), (N, 3, self.crop_size, self.crop_size), align_corners=False)
+        images = F.grid_sample(images.float() / 255, grid, mode='bilinear', align_corners=False)
+        # shifted by one so what lies outside the window (0) reads as ignore_index
+        labels = F.grid_sample(labels[:, None].float() + 1, grid, mode='nearest', align_corners=False)[:, 0] - 1
+        labels[labels < 0] = self.ignore_index
+
+        if self.jitter is not None:
+            images = self.color_jitter(images)
+        images = (images - self.mean.to(device)) / self.std.to(device)
+        return images, labels.long()
+
+    def color_jitter(self, images):
+        N = images.size(0)
+        brightness, contrast, saturation = self.jitter
+
+        def factors(amount):
+            return self.uniform(N, max(0, 1 - amount), 1 + amount).view(N, 1, 1, 1).to(images.device)
+
+        images = (images * factors(brightness)).clamp_(0, 1)
+        gray = (0.299 * images[:, 0] + 0.587 * images[:, 1] + 0.114 * images[:, 2]).unsqueeze(1)
+        images = _blend(images, gray.mean(dim=(2, 3), keepdim=True), factors(contrast))
+        gray = (0.299 * images[:, 0] + 0.587 * images[:, 1] + 0.114 * images[:, 2]).unsqueeze(1)
+        return _blend(images, gray, factors(saturation))
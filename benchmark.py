@@ -0,0 +1,133 @@
+import itertools
+import json
+import platform
+import subprocess
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def parse_size(size):
+    """ '513' -> (513, 513), '1024x2048' -> (1024, 2048)
+    """
+    parts = [int(x) for x in size.lower().split('x')]
+    return (parts[0], parts[0]) if len(parts) == 1 else tuple(parts)
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def peak_memory_mb(device):
+    """ peak allocated MB since the last reset on CUDA, process max RSS on CPU
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_steps(step, device, warmup, iters):
+    """ per-iteration latencies in ms, warmup iterations excluded
+    """
+    for _ in range(warmup):
+        step()
+    sync(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        step()
+        sync(device)
+        latencies.append(1000 * (time.perf_counter() - start))
+    return latencies
+
+
+def bench_config(opts, device, build_model, autocast, name, output_stride, separable_conv,
+                 size, batch_size, mode, num_classes=21):
+    model = build_model(name, num_classes, output_stride, separable_conv).to(device)
+    images = torch.randn(batch_size, 3, size[0], size[1], device=device)
+
+    if mode == 'infer':
+        model.eval()
+
+        def step():
+            with torch.no_grad(), autocast(opts, device):
+                model(images)
+    else:
+        model.train()
+        labels = torch.randint(0, num_classes, (batch_size, size[0], size[1]), device=device)
+        criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+
+        def step():
+            optimizer.zero_grad()
+            with autocast(opts, device):
+                loss = criterion(model(images), labels)
+            loss.backward()
+            optimizer.step()
+
+    latencies = time_steps(step, device, opts.bench_warmup, opts.bench_iters)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'model': name, 'output_stride': output_stride, 'separable_conv': separable_conv,
+        'height': size[0], 'width': size[1], 'batch_size': batch_size, 'mode': mode,
+        'precision': opts.precision,
+        'latency_ms': {'mean': float(np.mean(latencies)), 'p50': float(p50),
+                       'p95': float(p95), 'p99': float(p99)},
+        'images_per_sec': 1000 * batch_size / float(np.mean(latencies)),
+        'peak_mem_mb': peak_memory_mb(device),
+    }
+
+
+def run_benchmark(opts, device, build_model, autocast):
+    """Benchmark every combination of the --bench_* options and write them
+    to --bench_output as JSON.
+
+    On CPU the peak memory is the process max RSS, a high-water mark over the
+    whole run, so configurations are best compared from separate runs there.
+    """
+    torch.manual_seed(opts.random_seed)
+    separable = [False, True] if opts.bench_separable_conv else [False]
+    results = []
+    for name, stride, sep, size, bs, mode in itertools.product(
+            opts.bench_models, opts.bench_output_strides, separable, opts.bench_sizes,
+            opts.bench_batch_sizes, opts.bench_modes):
+        if sep and 'plus' not in name:
+            continue
+        if mode == 'train' and bs == 1:  # ASPP pooling leaves BatchNorm one value per channel
+            print("%s bs1 train: skipped, BatchNorm needs more than one sample per batch" % name)
+            continue
+        size = parse_size(size)
+        result = bench_config(opts, device, build_model, autocast, name, stride, sep, size, bs, mode)
+        print("%s os%d%s %dx%d bs%d %s: p50 %.1fms, p95 %.1fms, p99 %.1fms, %.1f img/s" %
+              (name, stride, ' sep' if sep else '', size[0], size[1], bs, mode,
+               result['latency_ms']['p50'], result['latency_ms']['p95'],
+               result['latency_ms']['p99'], result['images_per_sec']))
+        results.append(result)
+
+    report = {
+        'meta': {'commit': git_commit(), 'torch': torch.__version__, 'device': str(device),
+                 'threads': torch.get_num_threads(), 'platform': platform.platform(),
+                 'warmup': opts.bench_warmup, 'iters': opts.bench_iters},
+        'results': results,
+    }
+    with open(opts.bench_output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Benchmark results written to %s" % opts.bench_output)
+    return report
@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from main import MODEL_MAP, build_model, load_ckpt
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="Export a checkpoint to TorchScript and ONNX for segment.py")
+    parser.add_argument("--ckpt", type=str, required=True,
+                        help="checkpoint written by main.py")
+    parser.add_argument("--model", type=str, default='deeplabv3plus_mobilenet',
+                        choices=list(MODEL_MAP), help='model name')
+    parser.add_argument("--num_classes", type=int, default=21,
+                        help="num classes of the checkpoint (default: 21)")
+    parser.add_argument("--separable_conv", action='store_true', default=False,
+                        help="apply separable conv to decoder and aspp")
+    parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--height", type=int, default=513,
+                        help="height of the example input (default: 513)")
+    parser.add_argument("--width", type=int, default=513,
+                        help="width of the example input (default: 513)")
+    parser.add_argument("--output_dir", type=str, default='export',
+                        help="where to write model.pt, model.onnx and model.json")
+    parser.add_argument("--opset", type=int, default=13,
+                        help="ONNX opset version (default: 13)")
+    parser.add_argument("--no_onnx", action='store_true', default=False,
+                        help="only write the TorchScript artifact")
+    parser.add_argument("--atol", type=float, default=1e-2,
+                        help="max abs logit difference allowed against the eager model (default: 1e-2)")
+    return parser
+
+
+def fold_batchnorm(module):
+    """Fold every BatchNorm2d that directly follows a Conv2d among the children
+    of a module into that conv, replacing the BN by an Identity.
+
+    Children are matched in registration order, which is the forward order of
+    the ResNet, MobileNetV2, ASPP and decoder blocks; the parity check in
+    ``check_parity`` guards the assumption. Returns the number of folded BNs.
+    """
+    folded = 0
+    prev_name, prev = None, None
+    for name, child in list(module.named_children()):
+        if isinstance(child, nn.BatchNorm2d) and isinstance(prev, nn.Conv2d) \
+                and prev.out_channels == child.num_features:
+            setattr(module, prev_name, fuse_conv_bn_eval(prev, child))
+            setattr(module, name, nn.Identity())
+            folded += 1
+            prev_name, prev = None, None
+            continue
+        folded += fold_batchnorm(child)
+        prev_name, prev = name, child
+    return folded
+
+
+def compare(reference, outputs):
+    """ max abs logit difference and argmax agreement of two logit tensors
+    """
+    outputs = torch.as_tensor(outputs).float()
+    diff = (reference - outputs).abs().max().item()
+    agree = (reference.argmax(1) == outputs.argmax(1)).float().mean().item()
+    return diff, agree
+
+
+def check_parity(name, reference, outputs, atol):
+    diff, agree = compare(reference, outputs)
+    print("%s: max abs diff %.2e, argmax agreement %.4f%%" % (name, diff, 100 * agree))
+    if diff > atol:
+        raise RuntimeError("%s output differs from the eager model by %.2e > --atol %.2e"
+                           % (name, diff, atol))
+
+
+def main():
+    opts = get_argparser().parse_args()
+    os.makedirs(opts.output_dir, exist_ok=True)
+
+    model = build_model(opts.model, opts.num_classes, opts.output_stride, opts.separable_conv)
+    checkpoint = load_ckpt(opts.ckpt)
+    model.load_state_dict(checkpoint["model_state"])
+    del checkpoint
+    model.eval()
+
+    example = torch.randn(1, 3, opts.height, opts.width)
+    with torch.no_grad():
+        reference = model(example)
+        print("Folded %d BatchNorm layers" % fold_batchnorm(model))
+        check_parity('BN-folded', reference, model(example), opts.atol)
+
+        scripted = torch.jit.freeze(torch.jit.trace(model, example))
+        pt_path = os.path.join(opts.output_dir, 'model.pt')
+        scripted.save(pt_path)
+        check_parity('TorchScript', reference, torch.jit.load(pt_path)(example), opts.atol)
+        print("TorchScript model saved as %s" % pt_path)
+
+        if not opts.no_onnx:
+            onnx_path = os.path.join(opts.output_dir, 'model.onnx')
+            torch.onnx.export(model, example, onnx_path, opset_version=opts.opset,
+                              do_constant_folding=True,
+                              input_names=['image'], output_names=['logits'],
+                              dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                            'logits': {0: 'batch', 2: 'height', 3: 'width'}})
+            try:
+                import onnxruntime
+            except ImportError:
+                print("[!] onnxruntime not installed, ONNX parity not checked")
+            else:
+                session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+                check_parity('ONNX', reference, session.run(None, {'image': example.numpy()})[0], opts.atol)
+            print("ONNX model saved as %s" % onnx_path)
+
+    meta = {'model': opts.model, 'num_classes': opts.num_classes,
+            'output_stride': opts.output_stride, 'mean': MEAN, 'std': STD}
+    with open(os.path.join(opts.output_dir, 'model.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+CACHE_VERSION = 1
+FINGERPRINTS_NAME = 'checkpoints.json'
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def inference_settings(opts):
+    """ options a --test_only prediction depends on, besides the image and checkpoint
+    """
+    return {
+        'version': CACHE_VERSION, 'model': opts.model, 'num_classes': opts.num_classes,
+        'output_stride': opts.output_stride, 'separable_conv': opts.separable_conv,
+        'dataset': opts.dataset, 'crop_val': opts.crop_val, 'crop_size': opts.crop_size,
+        'precision': opts.precision, 'tile_size': opts.tile_size, 'tile_overlap': opts.tile_overlap,
+        'bucket_multiple': opts.bucket_multiple,  # batches are padded to it, which shifts border outputs
+        'class_map': file_hash(opts.class_map) if opts.class_map is not None else None,
+        'remap_predictions': opts.remap_predictions,
+    }
+
+
+class InferenceCache(object):
+    """Content-addressed cache of predicted class maps.
+
+    An entry is keyed by the SHA-256 of the input image file together with the
+    checkpoint fingerprint and the inference settings, and stored as a uint8
+    PNG under ``root``. Changing the image, the checkpoint or any setting thus
+    misses. Entries are touched when read, and ``evict`` removes the least
+    recently used ones beyond ``max_bytes``.
+
+    The checkpoint is hashed once; its hash is kept in ``checkpoints.json``
+    keyed by path, size and mtime.
+    """
+    def __init__(self, root, ckpt, settings, max_bytes=None):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evicted = 0
+        fingerprint = {'ckpt': self._ckpt_hash(ckpt), 'settings': settings}
+        self.fingerprint = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    def _ckpt_hash(self, ckpt):
+        path = os.path.join(self.root, FINGERPRINTS_NAME)
+        known = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                known = json.load(f)
+        st = os.stat(ckpt)
+        stamp = [st.st_size, st.st_mtime]
+        entry = known.get(os.path.abspath(ckpt))
+        if entry is None or entry['stat'] != stamp:
+            entry = {'stat': stamp, 'sha256': file_hash(ckpt)}
+            known[os.path.abspath(ckpt)] = entry
+            with open(path + '.tmp', 'w') as f:
+                json.dump(known, f)
+            os.replace(path + '.tmp', path)
+        return entry['sha256']
+
+    def key(self, image_path):
+        return hashlib.sha256((self.fingerprint + file_hash(image_path)).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.png')
+
+    def lookup(self, key):
+        """ whether key is cached, counting a hit or a miss and touching hits
+        """
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def get(self, key):
+        return np.asarray(Image.open(self._path(key)), dtype=np.uint8)
+
+    def put(self, key, pred):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))  # unique across threads too
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                Image.fromarray(np.asarray(pred, dtype=np.uint8)).save(f, format='PNG')
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def evict(self):
+        """ remove least recently used entries until the cache fits max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.png'):
+                    path = os.path.join(dirpath, name)
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evicted += 1
+
+    def summary(self):
+        lookups = max(self.hits + self.misses, 1)
+        return "Inference cache: %d hits, %d misses (%.1f%% hit rate), %d evicted" % (
+            self.hits, self.misses, 100. * self.hits / lookups, self.evicted)
@@ -1,30 +1,40 @@
-from tqdm import tqdm
+import time
+START_TIME = time.perf_counter()  # startup is measured from here, imports included
+
 import network
-import utils
+import utils  # its __init__ re-exports utils.visualizer, so visdom is loaded here too
 import os
 import random
 import argparse
+import contextlib
+import copy
+import json
+import queue
+import re
+import shutil
+import threading
+import zipfile
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from torch.utils import data
-from torchvision.utils import save_image
-from torchvision.transforms.functional import to_pil_image
 
 from datasets import VOCSegmentation, Cityscapes
 from utils import ext_transforms as et
 from metrics import StreamSegMetrics
+from memmap_cache import MemmapSegmentation
+from batch_aug import RawCropDataset, BatchAugment, window_size
+from streaming import run_stream
+from pred_store import PredictionWriter
 
 import torch
 import torch.nn as nn
-from utils.visualizer import Visualizer
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.utils.checkpoint
 
 from PIL import Image
-import matplotlib
-import matplotlib.pyplot as plt
-
-import torch
-torch.cuda.empty_cache()
-
 
 
 def get_argparser():
@@ -35,6 +45,14 @@ def get_argparser():
                         help="path to Dataset")
     parser.add_argument("--dataset", type=str, default='voc',
                         choices=['voc', 'cityscapes'], help='Name of dataset')
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="serve train/val from pre-decoded uint8 shards in this directory, built on first use")
+    parser.add_argument("--cache_verify", type=str, default='stat', choices=['stat', 'hash', 'none'],
+                        help="check cached samples against source files by size/mtime, content hash or not at all")
+    parser.add_argument("--class_map", type=str, default=None,
+                        help="JSON {\"source id\": target id} merging classes; unlisted ids are ignored")
+    parser.add_argument("--remap_predictions", action='store_true', default=False,
+                        help="with --class_map, keep the dataset's classes in the head and merge predictions")
     parser.add_argument("--num_classes", type=int, default=None,
                         help="num classes (default: None)")
 
@@ -53,6 +71,19 @@ def get_argparser():
                         help="save segmentation results to \"./results\"")
     parser.add_argument("--save_val_results_path",type = str,  default='./results/',
                         help="save segmentation results to \"./results\"")
+    parser.add_argument("--save_workers", type=int, default=4,
+                        help="background threads encoding result images (default: 4)")
+    parser.add_argument("--save_queue_size", type=int, default=64,
+                        help="max result images waiting to be written (default: 64)")
+    parser.add_argument("--drop_save_results", action='store_true', default=False,
+                        help="exit without writing result images still queued (default: wait for all)")
+    parser.add_argument("--save_format", type=str, default='png', choices=['png', 'store'],
+                        help="png: image, prediction and overlay files per image; store: class maps "
+                             "appended to a prediction store, see pred_store.py, one store "
+                             "val_itr<N> per validation round, val_itr<N>_rank<R> per rank "
+                             "with --distributed (default: png)")
+    parser.add_argument("--store_codec", type=str, default='zlib', choices=['zlib', 'raw'],
+                        help="compression of class maps in the prediction store (default: zlib)")
     parser.add_argument("--total_itrs", type=int, default=30e3,
                         help="epoch number (default: 30k)")
     parser.add_argument("--lr", type=float, default=0.01,
@@ -60,30 +91,110 @@ def get_argparser():
     parser.add_argument("--lr_policy", type=str, default='poly', choices=['poly', 'step'],
                         help="learning rate scheduler policy")
     parser.add_argument("--step_size", type=int, default=10000)
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help="autocast precision of forward and loss (default: fp32)")
+    parser.add_argument("--channels_last", action='store_true', default=False,
+                        help="keep weights and inputs in channels-last (NHWC) memory format")
+    parser.add_argument("--compile", action='store_true', default=False,
+                        help="run the model through torch.compile for training, validation and inference")
+    parser.add_argument("--compile_mode", type=str, default='default',
+                        choices=['default', 'reduce-overhead', 'max-autotune'],
+                        help="torch.compile mode (default: default)")
+    parser.add_argument("--compile_cache_limit", type=int, default=32,
+                        help="compiled variants kept per frame (input shapes, train/eval) before "
+                             "torch.compile gives up (default: 32)")
+    parser.add_argument("--tile_size", type=int, default=None,
+                        help="predict validation/test images in tiles of this size (default: whole image)")
+    parser.add_argument("--tile_overlap", type=int, default=128,
+                        help="overlap in pixels between neighbouring tiles (default: 128)")
+    parser.add_argument("--tile_batch_size", type=int, default=4,
+                        help="tiles per forward pass (default: 4)")
+    parser.add_argument("--bucket_multiple", type=int, default=32,
+                        help="--test_only batches images whose size rounded up to this multiple match (default: 32)")
+    parser.add_argument("--batch_timeout", type=float, default=None,
+                        help="--test_only runs a partial batch once its first image waited this many seconds")
+    parser.add_argument("--infer_cache", type=str, default=None,
+                        help="--test_only reuses predictions cached in this directory for unchanged images")
+    parser.add_argument("--infer_cache_size", type=float, default=2048,
+                        help="--infer_cache size limit in MB, least recently used entries go first (default: 2048)")
+    parser.add_argument("--stream", type=str, default=None,
+                        help="segment a video file or a growing image directory into --save_val_results_path")
+    parser.add_argument("--stream_poll", type=float, default=1.0,
+                        help="seconds between scans of a --stream directory (default: 1.0)")
+    parser.add_argument("--stream_idle_timeout", type=float, default=None,
+                        help="stop a --stream directory after this many seconds without new files (default: never)")
+    parser.add_argument("--stream_queue", type=int, default=8,
+                        help="frames buffered between --stream stages (default: 8)")
+    parser.add_argument("--stream_overlay", action='store_true', default=False,
+                        help="also write a color overlay of every --stream frame")
     parser.add_argument("--crop_val", action='store_true', default=False,
                         help='crop validation (default: False)')
     parser.add_argument("--batch_size", type=int, default=4,
                         help='batch size (default: 16)')
     parser.add_argument("--val_batch_size", type=int, default=4,
-                        help='batch size for validation (default: 4)')
+                        help='batch size for validation and --test_only (default: 4)')
     parser.add_argument("--crop_size", type=int, default=4)
 
+    parser.add_argument("--accum_steps", type=int, default=1,
+                        help="micro-batches of --batch_size accumulated per optimizer step; "
+                             "--total_itrs and the LR schedule count optimizer steps (default: 1)")
+    parser.add_argument("--grad_checkpoint", action='store_true', default=False,
+                        help="recompute backbone stage and ASPP activations in backward to save memory")
+
+    parser.add_argument("--batch_aug", action='store_true', default=False,
+                        help="augment whole uint8 batches on the device instead of per sample in the workers")
+    parser.add_argument("--num_workers", type=str, default='2',
+                        help="DataLoader workers, or 'auto' to pick workers and prefetch by a short probe (default: 2)")
+    parser.add_argument("--pin_memory", action='store_true', default=False,
+                        help="pin DataLoader batches for faster host-to-GPU copies")
+    parser.add_argument("--prefetch_factor", type=int, default=None,
+                        help="batches loaded ahead per worker (default: DataLoader default)")
+    parser.add_argument("--persistent_workers", action='store_true', default=False,
+                        help="keep DataLoader workers alive across epochs and validations")
     parser.add_argument("--ckpt", default=None, type=str,
                         help="restore from checkpoint")
+    parser.add_argument("--startup_budget", type=float, default=None,
+                        help="fail if startup up to the first step or image exceeds this many seconds")
     parser.add_argument("--continue_training", action='store_true', default=False)
+    parser.add_argument("--ckpt_keep", type=int, default=0,
+                        help="also keep the last N saves of each checkpoint as *_itr<N>.pth (default: 0)")
 
     parser.add_argument("--loss_type", type=str, default='cross_entropy',
                         choices=['cross_entropy', 'focal_loss'], help="loss type (default: False)")
     parser.add_argument("--gpu_id", type=str, default='0',
-                        help="GPU ID")
+                        help="GPU ID (ignored with --distributed, torchrun assigns one GPU per process)")
+    parser.add_argument("--distributed", action='store_true', default=False,
+                        help="DistributedDataParallel training, launch with torchrun --nproc_per_node=N")
+    parser.add_argument("--dist_backend", type=str, default=None, choices=['nccl', 'gloo'],
+                        help="process group backend (default: nccl with CUDA, gloo on CPU)")
     parser.add_argument("--weight_decay", type=float, default=1e-4,
                         help='weight decay (default: 1e-4)')
     parser.add_argument("--random_seed", type=int, default=1,
                         help="random seed (default: 1)")
     parser.add_argument("--print_interval", type=int, default=10,
                         help="print interval of loss (default: 10)")
+    parser.add_argument("--perf_stats", action='store_true', default=False,
+                        help="report data/forward/backward/step time, img/s and peak memory every print interval")
+    parser.add_argument("--perf_log", type=str, default=None,
+                        help="append --perf_stats records to this file as JSON lines")
+    parser.add_argument("--profile_steps", type=str, default=None,
+                        help="profile iterations A to B-1 (from 0) given as A:B, writing a Chrome trace "
+                             "and a per-module time/FLOPs/activation table, on rank 0 with --distributed")
+    parser.add_argument("--profile_phase", type=str, default='train', choices=['train', 'val'],
+                        help="profile training iterations or those of the first synchronous validation (default: train)")
+    parser.add_argument("--profile_dir", type=str, default='profile',
+                        help="where to write <phase>_trace.json (default: ./profile)")
     parser.add_argument("--val_interval", type=int, default=100,
                         help="epoch interval for eval (default: 100)")
+    parser.add_argument("--val_subset", type=int, default=None,
+                        help="validate on this many fixed, evenly spaced val samples (default: all)")
+    parser.add_argument("--full_val_every", type=int, default=10,
+                        help="with --val_subset, every N-th validation uses the full val set; "
+                             "only full validations select best_*.pth (default: 10)")
+    parser.add_argument("--async_val", action='store_true', default=False,
+                        help="validate checkpoint snapshots in a separate process while training continues")
+    parser.add_argument("--async_val_device", type=str, default='cpu',
+                        help="device of the --async_val process (default: cpu)")
     parser.add_argument("--download", action='store_true', default=False,
                         help="download datasets")
 
@@ -91,6 +202,29 @@ def get_argparser():
     parser.add_argument("--year", type=str, default='2012',
                         choices=['2012_aug', '2012', '2011', '2009', '2008', '2007'], help='year of VOC')
 
+    # Benchmark Options
+    parser.add_argument("--benchmark", action='store_true', default=False,
+                        help="benchmark model_map configurations on synthetic inputs and exit")
+    parser.add_argument("--bench_models", type=str, nargs='+', default=None,
+                        help="model_map names to benchmark (default: all)")
+    parser.add_argument("--bench_sizes", type=str, nargs='+', default=['513'],
+                        help="input resolutions as S or HxW (default: 513)")
+    parser.add_argument("--bench_batch_sizes", type=int, nargs='+', default=[1, 4],
+                        help="batch sizes to benchmark; train mode skips 1, which BatchNorm "
+                             "after ASPP pooling cannot train on (default: 1 4)")
+    parser.add_argument("--bench_output_strides", type=int, nargs='+', default=[16], choices=[8, 16],
+                        help="output strides to benchmark (default: 16)")
+    parser.add_argument("--bench_separable_conv", action='store_true', default=False,
+                        help="also benchmark deeplabv3plus models with separable conv")
+    parser.add_argument("--bench_modes", type=str, nargs='+', default=['infer', 'train'],
+                        choices=['infer', 'train'], help="benchmark inference and/or a training step")
+    parser.add_argument("--bench_warmup", type=int, default=5,
+                        help="untimed iterations per configuration (default: 5)")
+    parser.add_argument("--bench_iters", type=int, default=20,
+                        help="timed iterations per configuration (default: 20)")
+    parser.add_argument("--bench_output", type=str, default='benchmark.json',
+                        help="where to write benchmark results as JSON")
+
     # Visdom options
     parser.add_argument("--enable_vis", action='store_true', default=False,
                         help="use visdom for visualization")
@@ -103,10 +237,194 @@ def get_argparser():
     return parser
 
 
-def get_dataset(opts):
-    """ Dataset And Augmentation
+MODEL_MAP = {
+    'deeplabv3_resnet50': network.deeplabv3_resnet50,
+    'deeplabv3plus_resnet50': network.deeplabv3plus_resnet50,
+    'deeplabv3_resnet101': network.deeplabv3_resnet101,
+    'deeplabv3plus_resnet101': network.deeplabv3plus_resnet101,
+    'deeplabv3_mobilenet': network.deeplabv3_mobilenet,
+    'deeplabv3plus_mobilenet': network.deeplabv3plus_mobilenet
+}
+
+
+def build_model(name, num_classes, output_stride, separable_conv=False):
+    """ model_map network with the training-time BN momentum
+    """
+    model = MODEL_MAP[name](num_classes=num_classes, output_stride=output_stride)
+    if separable_conv and 'plus' in name:
+        network.convert_to_separable_conv(model.classifier)
+    utils.set_bn_momentum(model.backbone, momentum=0.01)
+    return model
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    """ BatchNorm running stats of module left untouched, for recomputed forwards
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, tracked) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(tracked)
+
+
+class CheckpointedModule(object):
+    """Mixin recomputing a module's forward in backward instead of keeping its
+    activations. The recomputation leaves BatchNorm running stats alone, so
+    they are updated once per step as without checkpointing.
+    """
+    def forward(self, *args):
+        if not (self.training and torch.is_grad_enabled()):
+            return super(CheckpointedModule, self).forward(*args)
+        return torch.utils.checkpoint.checkpoint(
+            super(CheckpointedModule, self).forward, *args, use_reentrant=False,
+            context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(self)))
+
+
+_CHECKPOINTED_CLASSES = {}
+
+
+def enable_grad_checkpoint(model):
+    """Checkpoint the activations of the backbone stages (ResNet layer1-4,
+    MobileNet low/high level features) and of ASPP.
+
+    Modules are switched in place to a subclass with CheckpointedModule
+    mixed in, so parameters, state_dict keys and checkpoints are unchanged.
+    Returns the number of checkpointed modules.
+    """
+    from network._deeplab import ASPP
+    targets = [m for name, m in model.backbone.named_children()
+               if name.startswith('layer') or name.endswith('_features')]
+    targets += [m for m in model.classifier.modules() if isinstance(m, ASPP)]
+    for m in targets:
+        cls = type(m)
+        if cls not in _CHECKPOINTED_CLASSES:
+            _CHECKPOINTED_CLASSES[cls] = type('Checkpointed' + cls.__name__, (CheckpointedModule, cls), {})
+        m.__class__ = _CHECKPOINTED_CLASSES[cls]
+    return len(targets)
+
+
+DATASET_CLASSES = {'voc': 21, 'cityscapes': 19}
+
+
+def load_class_map(path, ignore_index=255):
+    """Lookup table merging label ids, read from a JSON {"source id": target id}
+    file. Source ids missing from the file, or mapped to ignore_index, are
+    ignored. Returns the 256-entry uint8 table and the number of target
+    classes, ignore_index not counted.
+    """
+    with open(path) as f:
+        mapping = {int(k): int(v) for k, v in json.load(f).items()}
+    lut = np.full(256, ignore_index, dtype=np.uint8)
+    for src, dst in mapping.items():
+        if dst != ignore_index and not 0 <= dst < 255:
+            raise ValueError("class map %s: target id %d of %d must be in [0, 255) or %d"
+                             % (path, dst, src, ignore_index))
+        lut[src] = dst
+    targets = [dst for dst in mapping.values() if dst != ignore_index]
+    if not targets:
+        raise ValueError("class map %s maps every id to %d" % (path, ignore_index))
+    return lut, max(targets) + 1
+
+
+def head_classes(opts):
+    """ output classes of the network, the dataset's own with --remap_predictions
+    """
+    if opts.class_map is not None and opts.remap_predictions:
+        return DATASET_CLASSES[opts.dataset.lower()]
+    return opts.num_classes
+
+
+def prediction_lut(opts, device):
+    """ --class_map table applied to predictions, or None
+    """
+    if opts.class_map is None or not opts.remap_predictions:
+        return None
+    lut, _ = load_class_map(opts.class_map)
+    return torch.from_numpy(lut).long().to(device)
+
+
+class RemapTargets(data.Dataset):
+    """Apply a class lookup table to the targets of a dataset, one indexing
+    operation per sample.
+    """
+    def __init__(self, dataset, lut):
+        self.dataset = dataset
+        self.lut = lut
+        self.lut_t = torch.from_numpy(lut)
+        self.decode_target = dataset.decode_target
+
+    def __getitem__(self, index):
+        img, target, *extra = self.dataset[index]  # RawCropDataset also returns the image size
+        if torch.is_tensor(target):
+            target = self.lut_t[target.long()]
+        else:
+            target = self.lut[np.asarray(target)]
+        return (img, target, *extra)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def base_sample(dataset, index):
+    """ (index, absolute image path or None) of ``dataset[index]`` in the
+    dataset under any Subset and RemapTargets wrappers
+    """
+    while isinstance(dataset, (data.Subset, RemapTargets)):
+        if isinstance(dataset, data.Subset):
+            index = dataset.indices[index]
+        dataset = dataset.dataset
+    if hasattr(dataset, 'images'):
+        return index, os.path.abspath(dataset.images[index])
+    if hasattr(dataset, 'samples'):  # MemmapSegmentation
+        return index, dataset.samples[index]['sources'][0]['path']
+    return index, None
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff', '.webp')
+
+
+class ImageFolder(data.Dataset):
+    """Unlabeled images of a directory, decoded lazily in __getitem__.
+
+    Only the sorted file list is kept in memory, so peak memory is bounded by
+    the DataLoader prefetch depth rather than by the size of the directory.
+    Items are ``(image, path)`` tuples.
+    """
+    def __init__(self, root, transform=None):
+        self.root = root
+        self.transform = transform
+        self.images = sorted(os.path.join(root, x) for x in os.listdir(root)
+                             if x.lower().endswith(IMG_EXTENSIONS))
+
+    def __getitem__(self, index):
+        path = self.images[index]
+        img = Image.open(path).convert('RGB')
+        if self.transform is not None:
+            img, _ = self.transform(img, img)
+        return img, path
+
+    def __len__(self):
+        return len(self.images)
+
+
+# (scale range, color jitter) of --batch_aug, matching train_transform in get_dataset
+BATCH_AUG = {
+    'voc': ((0.5, 2.0), None),
+    'cityscapes': ((1.0, 1.0), (0.5, 0.5, 0.5)),
+}
+
+
+def get_dataset(opts, splits=('train', 'val', 'test')):
+    """ Dataset And Augmentation, building only the given splits; the others
+    are None. The test split is only built with --test_only.
     """
-    test_dst = []
+    train_dst = val_dst = test_dst = None
     if opts.dataset == 'voc':
         train_transform = et.ExtCompose([
             #et.ExtResize(size=opts.crop_size),
@@ -131,16 +449,15 @@ def get_dataset(opts):
                 et.ExtNormalize(mean=[0.485, 0.456, 0.406],
                                 std=[0.229, 0.224, 0.225]),
             ])
-        train_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
-                                    image_set='train', download=opts.download, transform=train_transform)
-        val_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
-                                  image_set='val', download=False, transform=val_transform)
-        if opts.test_only:
-            path = os.path.join(opts.data_root, '../../test/')
-            paths = sorted([os.path.join(path, x) for x in os.listdir(path)])
-            imgs = [Image.open(x).convert('RGB') for x in paths]
-            imgs = [val_transform(img,img) for img in imgs]
-            test_dst = imgs
+        if 'train' in splits:
+            train_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
+                                        image_set='train', download=opts.download, transform=train_transform)
+        if 'val' in splits:
+            val_dst = VOCSegmentation(root=opts.data_root, year=opts.year,
+                                      image_set='val', download=False, transform=val_transform)
+        if 'test' in splits and opts.test_only:
+            test_dst = ImageFolder(root=os.path.join(opts.data_root, '../../test/'),
+                                   transform=val_transform)
 
     if opts.dataset == 'cityscapes':
         train_transform = et.ExtCompose([
@@ -161,13 +478,15 @@ def get_dataset(opts):
         ])
 
 
-        train_dst = Cityscapes(root=opts.data_root,
-                               split='train', transform=train_transform)
-
-        val_dst = Cityscapes(root=opts.data_root,
-                             split='val', transform=val_transform)
-        test_dst = Cityscapes(root=opts.data_root,
-                               split='test', transform=train_transform)
+        if 'train' in splits:
+            train_dst = Cityscapes(root=opts.data_root,
+                                   split='train', transform=train_transform)
+        if 'val' in splits:
+            val_dst = Cityscapes(root=opts.data_root,
+                                 split='val', transform=val_transform)
+        if 'test' in splits and opts.test_only:
+            test_dst = Cityscapes(root=opts.data_root,
+                                   split='test', transform=train_transform)
         
 #        if opts.test_only:
 #            path = os.path.join(opts.data_root, 'leftImg8bit/tests/')
@@ -178,117 +497,865 @@ def get_dataset(opts):
 #        else:
 #            test_dst = val_dst
 
+    if opts.cache_dir is not None:
+        name = opts.dataset + ('_' + opts.year if opts.dataset == 'voc' else '')
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed and not is_main_process():
+            dist.barrier()  # rank 0 builds a cold cache alone, the others open it afterwards
+        if train_dst is not None:
+            train_dst = MemmapSegmentation(train_dst, os.path.join(opts.cache_dir, name + '_train'),
+                                           transform=train_transform, verify=opts.cache_verify)
+        if val_dst is not None:
+            val_dst = MemmapSegmentation(val_dst, os.path.join(opts.cache_dir, name + '_val'),
+                                         transform=val_transform, verify=opts.cache_verify)
+        if distributed and is_main_process():
+            dist.barrier()
+
+    if opts.batch_aug and train_dst is not None:
+        scale_range, _ = BATCH_AUG[opts.dataset]
+        train_dst = RawCropDataset(train_dst, window_size(opts.crop_size, scale_range[0]))
+
+    if opts.class_map is not None:
+        lut, _ = load_class_map(opts.class_map)
+        if train_dst is not None and not opts.remap_predictions:  # otherwise the head keeps the dataset's classes
+            train_dst = RemapTargets(train_dst, lut)
+        if val_dst is not None:
+            val_dst = RemapTargets(val_dst, lut)
+
     return train_dst, val_dst, test_dst
 
 
 
-def validate(opts, model, loader, device, metrics, ret_samples_ids=None):
+class DeviceSegMetrics(StreamSegMetrics):
+    """StreamSegMetrics accumulating the confusion matrix on the device of its
+    inputs. Labels and predictions are never copied to the host; only the
+    matrix is, when get_results() is called.
+
+    Predictions outside the classes (a class map sends them to ignore) count
+    in an extra void column: they are misses of their target class, in its
+    accuracy and IoU denominators, but hits of no class.
+    """
+    def __init__(self, n_classes, device='cpu'):
+        self.device = torch.device(device)
+        super(DeviceSegMetrics, self).__init__(n_classes)
+        self.reset()
+
+    def update(self, label_trues, label_preds):
+        label_trues = torch.as_tensor(label_trues)
+        label_preds = torch.as_tensor(label_preds, device=label_trues.device).long()
+        n = self.n_classes
+        label_preds = torch.where(label_preds < n, label_preds, torch.full_like(label_preds, n))
+        # ignored labels go to one extra bin that is dropped
+        valid = (label_trues >= 0) & (label_trues < n)
+        idx = torch.where(valid, (n + 1) * label_trues.long() + label_preds,
+                          torch.full_like(label_preds, n * (n + 1)))
+        hist = torch.bincount(idx.flatten(), minlength=n * (n + 1) + 1)[:n * (n + 1)].view(n, n + 1)
+        self.hist += hist.to(self.device)
+
+    def synchronize(self):
+        """ sum the confusion matrices of all ranks of the process group
+        """
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.hist)
+
+    def get_results(self):
+        """Returns accuracy score evaluation result, as StreamSegMetrics.
+            - overall accuracy
+            - mean accuracy
+            - mean IU
+            - fwavacc
+        """
+        hist = self.hist.cpu().numpy().astype(np.float64)
+        self.confusion_matrix = hist[:, :self.n_classes]
+        tp = np.diag(hist)
+        gt = hist.sum(axis=1)  # void predictions included
+        pred = self.confusion_matrix.sum(axis=0)
+        acc = tp.sum() / gt.sum()
+        acc_cls = np.nanmean(tp / gt)
+        iu = tp / (gt + pred - tp)
+        mean_iu = np.nanmean(iu)
+        freq = gt / gt.sum()
+        fwavacc = (freq[freq > 0] * iu[freq > 0]).sum()
+        cls_iu = dict(zip(range(self.n_classes), iu))
+        return {
+            "Overall Acc": acc,
+            "Mean Acc": acc_cls,
+            "FreqW Acc": fwavacc,
+            "Mean IoU": mean_iu,
+            "Class IoU": cls_iu,
+        }
+
+    def reset(self):
+        super(DeviceSegMetrics, self).reset()
+        self.hist = torch.zeros((self.n_classes, self.n_classes + 1), dtype=torch.long, device=self.device)
+
+
+OVERLAY_ALPHA = 0.7
+MASK_CMAP = np.array([[68, 1, 84], [253, 231, 37]], dtype=np.uint8)  # viridis ends, as plt.imshow drew masks
+
+
+class ResultWriter(object):
+    """Encode and write result images on a bounded pool of background threads.
+
+    PIL releases the GIL while compressing PNGs, so a few threads keep up with
+    the forward pass. At most ``max_pending`` jobs are queued; ``submit`` blocks
+    beyond that instead of buffering without limit. With a PredictionWriter
+    ``store``, callers append class maps to it instead of writing PNGs; it is
+    closed along with the pool.
+    """
+    def __init__(self, num_workers=4, max_pending=64, store=None):
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.store = store
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+        self.dropped = 0
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.slots.release()
+        if future.cancelled():
+            self.dropped += 1
+        elif future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def close(self, drop=False):
+        """ wait for pending writes, or drop the ones not yet started; running
+        ones always finish, as the store is closed after them
+        """
+        self.pool.shutdown(wait=True, cancel_futures=drop)
+        if self.dropped:
+            print("[!] %d result writes dropped at exit" % self.dropped)
+        if self.store is not None:
+            self.store.close()
+        if self.errors:
+            raise self.errors[0]
+
+
+def blend_overlay(image, mask, alpha=OVERLAY_ALPHA):
+    """Alpha-blend an RGB uint8 mask over an RGB uint8 image"""
+    out = image.astype(np.float32) * (1 - alpha) + mask.astype(np.float32) * alpha
+    return out.astype(np.uint8)
+
+
+def to_uint8_image(image, denorm):
+    return (denorm(image) * 255).transpose(1, 2, 0).astype(np.uint8)
+
+
+def save_val_overlay(path, image, pred, denorm, decode_target):
+    image = to_uint8_image(image, denorm)
+    pred = decode_target(pred).astype(np.uint8)
+    Image.fromarray(blend_overlay(image, pred)).save(path)
+
+
+def save_test_results(prefix, image, pred, denorm, class_mapped=False):
+    image = to_uint8_image(image, denorm)
+    Image.fromarray(image).save(prefix + '_image.png')
+    if class_mapped:  # --class_map already merged the classes
+        Image.fromarray(pred.astype(np.uint8)).save(prefix + '_pred.png')
+        mask = VOCSegmentation.decode_target(pred).astype(np.uint8)
+    else:
+        predfull = (pred==1) + (pred==1) + (pred == 9)  #merge road, sidewalk, terrain
+        Image.fromarray(predfull).save(prefix + '_predfull.png')
+        mask = MASK_CMAP[predfull.astype(np.uint8)]
+    Image.fromarray(blend_overlay(image, mask)).save(prefix + '_overlay.png')
+
+
+AUTOCAST_DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(opts, device):
+    """ autocast context for forward and loss at --precision; weights stay fp32
+    """
+    dtype = AUTOCAST_DTYPES[opts.precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def tile_starts(size, tile, stride):
+    """ tile offsets covering [0, size), the last tile flush with the end
+    """
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def sliding_window(model, images, tile_size, overlap, tile_batch_size):
+    """Predict logits tile by tile and average overlapping tiles into a
+    full-size map. Activation memory follows tile_size * tile_batch_size; only
+    the NxCxHxW logits buffer grows with the image.
+    """
+    N, _, H, W = images.shape
+    pad_h, pad_w = max(tile_size - H, 0), max(tile_size - W, 0)
+    if pad_h or pad_w:  # zero is the dataset mean after normalization
+        images = F.pad(images, (0, pad_w, 0, pad_h))
+    Hp, Wp = images.shape[-2:]
+    stride = tile_size - overlap
+    offsets = [(y, x) for y in tile_starts(Hp, tile_size, stride)
+                      for x in tile_starts(Wp, tile_size, stride)]
+    tiles = [(n, y, x) for n in range(N) for (y, x) in offsets]
+
+    counts = images.new_zeros((1, 1, Hp, Wp))
+    for (y, x) in offsets:
+        counts[..., y:y+tile_size, x:x+tile_size] += 1
+    logits = None
+    for i in range(0, len(tiles), tile_batch_size):
+        batch = tiles[i:i+tile_batch_size]
+        crops = torch.stack([images[n, :, y:y+tile_size, x:x+tile_size] for (n, y, x) in batch])
+        outputs = model(crops).float()
+        if logits is None:
+            logits = outputs.new_zeros((N, outputs.size(1), Hp, Wp))
+        for output, (n, y, x) in zip(outputs, batch):
+            logits[n, :, y:y+tile_size, x:x+tile_size] += output
+    return (logits / counts)[:, :, :H, :W]
+
+
+def to_model_format(opts, images):
+    """ a batch in the memory format of the model weights
+    """
+    if opts.channels_last:
+        return images.contiguous(memory_format=torch.channels_last)
+    return images
+
+
+def compile_model(opts, model):
+    """Compile the network inside its DataParallel/DDP wrapper in place.
+
+    ``nn.Module.compile`` keeps the module and its parameter names, so
+    ``model.module.state_dict()`` stays loadable by eager models. Every new
+    input shape or train/eval switch is logged as a recompile; past
+    --compile_cache_limit variants torch raises instead of quietly running
+    the frame eagerly, where it supports that.
+    """
+    net = model.module
+    if not hasattr(net, 'compile'):
+        raise RuntimeError("--compile needs torch >= 2.2 (nn.Module.compile)")
+    import torch._dynamo
+    torch._dynamo.config.cache_size_limit = opts.compile_cache_limit
+    if hasattr(torch._dynamo.config, 'fail_on_cache_limit_hit'):
+        torch._dynamo.config.fail_on_cache_limit_hit = True
+    torch._logging.set_logs(recompiles=True)
+    net.compile(mode=opts.compile_mode)
+
+
+def warmup_model(opts, model, device, train=True):
+    """Run the compiled model once in each mode it will be used in, so the
+    first iterations do not pay for compilation. Training warmup runs forward
+    and backward on a --crop_size batch without touching BatchNorm stats;
+    evaluation warmup uses --crop_size with --crop_val, otherwise 513, and
+    other sizes compile on first use.
+    """
+    start = time.perf_counter()
+    if train:
+        images = torch.randn(opts.batch_size, 3, opts.crop_size, opts.crop_size, device=device)
+        model.train()
+        with frozen_bn_stats(model), autocast(opts, device):
+            outputs = model(to_model_format(opts, images))
+        outputs.float().mean().backward()
+        model.zero_grad(set_to_none=True)
+    size = opts.crop_size if opts.crop_val else 513
+    images = torch.randn(opts.val_batch_size, 3, size, size, device=device)
+    model.eval()
+    with torch.no_grad(), autocast(opts, device):
+        model(to_model_format(opts, images))
+    print("Model compiled and warmed up in %.1fs" % (time.perf_counter() - start))
+
+
+def predict(opts, model, images):
+    """ logits of a batch, tiled with --tile_size when it is set
+    """
+    images = to_model_format(opts, images)
+    if opts.tile_size is None:
+        return model(images)
+    return sliding_window(model, images, opts.tile_size, opts.tile_overlap, opts.tile_batch_size)
+
+
+class ThroughputMeter(object):
+    """Per-phase wall time, images/sec and peak memory over a print interval.
+
+    CUDA work is asynchronous, so ``mark`` synchronizes the device to charge
+    time to the phase that spent it. A disabled meter does nothing and never
+    synchronizes.
+    """
+    PHASES = ('data', 'forward', 'backward', 'step')
+
+    def __init__(self, device, enabled=False, log_path=None):
+        self.device = device
+        self.enabled = enabled
+        self.log_file = open(log_path, 'a') if enabled and log_path else None
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.images = 0
+        self.itrs = 0
+        if self.enabled and self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.last = time.perf_counter()
+
+    def restart(self):
+        """ resume timing, dropping the time since the last mark
+        """
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.times[phase] += now - self.last
+        self.last = now
+
+    def update(self, batch_size):
+        self.images += batch_size
+        self.itrs += 1
+
+    def peak_memory(self):
+        """ peak MB allocated on the device, or the process max RSS on CPU
+        """
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        try:
+            import resource
+        except ImportError:  # not available on Windows
+            return float('nan')
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def report(self, **fields):
+        if not self.enabled or self.itrs == 0:
+            return None
+        total = sum(self.times.values())
+        record = dict(fields)
+        for phase in self.PHASES:
+            record['%s_ms' % phase] = 1000 * self.times[phase] / self.itrs
+        record['images_per_sec'] = self.images / total if total > 0 else 0.0
+        record['peak_mem_mb'] = self.peak_memory()
+        print("  [perf] data %.1fms, forward %.1fms, backward %.1fms, step %.1fms per itr, %.1f img/s, peak mem %.0fMB" %
+              (record['data_ms'], record['forward_ms'], record['backward_ms'], record['step_ms'],
+               record['images_per_sec'], record['peak_mem_mb']))
+        if self.log_file is not None:
+            self.log_file.write(json.dumps(record) + '\n')
+            self.log_file.flush()
+        self.reset()
+        return record
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+
+
+def link_or_copy(src, dst):
+    """ hard-link src to dst, copying where the filesystem has no hard links
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def to_cpu(obj):
+    """ copy of a (nested) state dict with every tensor cloned to host memory
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """Write checkpoints from a background thread.
+
+    ``save`` snapshots the state into host memory on the calling thread and
+    returns. The file is written to ``<path>.tmp``, fsynced and renamed over
+    ``path``, so a crash never leaves a truncated checkpoint behind. With
+    ``keep`` > 0 the last ``keep`` saves of every path are also kept as
+    ``<name>_itr<N>.pth`` hard links. At most ``max_pending`` snapshots are
+    held in memory; ``save`` blocks beyond that.
+    """
+    def __init__(self, keep=0, max_pending=2):
+        self.keep = keep
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def save(self, state, path, itrs=None):
+        for future in [f for f in self.futures if f.done()]:
+            self.futures.remove(future)
+            future.result()  # surface a failed earlier write
+        self.slots.acquire()
+        future = self.pool.submit(self._write, to_cpu(state), path, itrs)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def _write(self, state, path, itrs):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if self.keep > 0 and itrs is not None:
+            self._rotate(path, itrs)
+        print("Model saved as %s" % path)
+
+    def _rotate(self, path, itrs):
+        root, ext = os.path.splitext(path)
+        kept = '%s_itr%d%s' % (root, itrs, ext)
+        link_or_copy(path, kept)
+        pattern = re.compile(re.escape(os.path.basename(root)) + r'_itr(\d+)' + re.escape(ext) + '$')
+        folder = os.path.dirname(path) or '.'
+        history = sorted((int(m.group(1)), m.group(0)) for m in map(pattern.match, os.listdir(folder)) if m)
+        for _, name in history[:-self.keep]:
+            os.remove(os.path.join(folder, name))
+
+    def wait(self):
+        """ block until every queued checkpoint is on disk, re-raising write errors
+        """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+def check_ckpt(path):
+    """ refuse checkpoints left incomplete by an interrupted write
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    # torch.save writes zip archives since 1.6; their directory sits at the end of the file
+    if magic == b'PK' and not zipfile.is_zipfile(path):
+        raise RuntimeError("Checkpoint %s is truncated, it was not completely written" % path)
+    if os.path.exists(path + '.tmp'):
+        print("[!] %s.tmp exists, a later save of this checkpoint was interrupted" % path)
+
+
+def load_ckpt(path):
+    """Checked checkpoint loaded on the CPU. Tensors are memory-mapped from the
+    file where torch supports it, so nothing is read until load_state_dict
+    copies it; torch < 2.1 and pre-zip checkpoints are read in full.
+    """
+    check_ckpt(path)
+    try:
+        return torch.load(path, map_location=torch.device('cpu'), mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location=torch.device('cpu'))
+
+
+def report_startup(marks, budget=None):
+    """ print the time of each startup phase, marks being (phase, perf_counter) pairs
+    """
+    phases, last = [], START_TIME
+    for phase, t in marks:
+        phases.append('%s %.2fs' % (phase, t - last))
+        last = t
+    total = last - START_TIME
+    print("Startup: %s, total %.2fs" % (', '.join(phases), total))
+    if budget is not None and total > budget:
+        raise RuntimeError("Startup took %.2fs, over the --startup_budget of %.2fs" % (total, budget))
+
+
+def init_distributed(opts):
+    """ join the process group started by torchrun, returns (rank, world_size, local_rank)
+    """
+    if not opts.distributed:
+        return 0, 1, 0
+    backend = opts.dist_backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def parallelize(opts, model, device, train=True):
+    """ move the model to its device and wrap it for multi-device training
+    """
+    model.to(device)
+    if opts.channels_last:
+        model.to(memory_format=torch.channels_last)
+    if opts.distributed and train:
+        return nn.parallel.DistributedDataParallel(
+            model, device_ids=[device.index] if device.type == 'cuda' else None)
+    if opts.distributed:  # rank 0 infers alone, DDP forwards would wait on the other ranks
+        return nn.DataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    return nn.DataParallel(model)
+
+
+def make_loader(opts, dataset, batch_size, shuffle=False, sampler=None):
+    """ DataLoader with the --num_workers, --pin_memory, --prefetch_factor and
+    --persistent_workers settings
+    """
+    extra = {}
+    if opts.num_workers > 0:
+        extra['persistent_workers'] = opts.persistent_workers
+        if opts.prefetch_factor is not None:
+            extra['prefetch_factor'] = opts.prefetch_factor
+    return data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                           sampler=sampler, num_workers=opts.num_workers,
+                           pin_memory=opts.pin_memory, **extra)
+
+
+def autotune_loader(opts, dataset, batch_size, step, shuffle=False, sampler=None, num_batches=20):
+    """Pick --num_workers and --prefetch_factor by measuring data wait.
+
+    Every candidate loader feeds ``step`` (a forward pass of the model) for
+    ``num_batches`` batches after one warmup batch that absorbs worker startup.
+    The least time blocked on the loader wins; within 5% of it the setting
+    with fewer workers is preferred. The choice is stored on ``opts``.
+    """
+    cpus = os.cpu_count() or 1
+    workers = sorted({1, 2, cpus} | {2 ** k for k in range(2, 7) if 2 ** k <= cpus})
+    candidates = [(0, None)] + [(w, p) for w in workers for p in (2, 4)]
+    rng_state = torch.get_rng_state()
+    results = []
+    for num_workers, prefetch in candidates:
+        opts.num_workers, opts.prefetch_factor = num_workers, prefetch
+        batches = iter(make_loader(opts, dataset, batch_size, shuffle=shuffle, sampler=sampler))
+        next(batches)
+        waited, count = 0.0, 0
+        for _ in range(num_batches):
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                break
+            waited += time.perf_counter() - start
+            count += 1
+            step(batch)
+        del batches  # stops the workers
+        results.append((1000 * waited / max(count, 1), num_workers, prefetch))
+        print("  [autotune] num_workers %d, prefetch_factor %s: %.1fms data wait per batch" %
+              (num_workers, prefetch, results[-1][0]))
+    torch.set_rng_state(rng_state)
+
+    best = min(r[0] for r in results)
+    wait, num_workers, prefetch = min((r for r in results if r[0] <= best * 1.05 + 0.1),
+                                      key=lambda r: (r[1], r[2] or 0))
+    opts.num_workers, opts.prefetch_factor = num_workers, prefetch
+    print("DataLoader autotune: num_workers=%d, prefetch_factor=%s, %.1fms data wait per batch" %
+          (num_workers, prefetch, wait))
+
+
+def val_subset_indices(size, n):
+    """ n evenly spaced indices, so every subset validation sees the same samples
+    """
+    if n is None or n >= size:
+        return list(range(size))
+    return np.linspace(0, size - 1, n).round().astype(int).tolist()
+
+
+class ShardSampler(data.Sampler):
+    """Indices rank, rank + world_size, ... of a dataset, in order.
+
+    Unlike DistributedSampler it does not pad the shards to one length with
+    repeated samples, so metrics summed over the ranks count every sample
+    exactly once. Shards differ by at most one sample; nothing collective may
+    run per batch.
+    """
+    def __init__(self, dataset):
+        self.size = len(dataset)
+        self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+    def __iter__(self):
+        return iter(range(self.rank, self.size, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.size, self.world_size))
+
+
+def eval_worker(opts, tasks, results):
+    """Evaluate checkpoint snapshots sent by the training process.
+
+    Each task is (itrs, path, full); the scores go back as
+    (itrs, path, full, score). The worker is a daemon process, which may not
+    start DataLoader workers, so it loads data in-process.
+    """
+    device = torch.device(opts.async_val_device)
+    _, val_dst, _ = get_dataset(opts, splits=('val',))
+    subset = data.Subset(val_dst, val_subset_indices(len(val_dst), opts.val_subset))
+    loaders = {True: data.DataLoader(val_dst, batch_size=opts.val_batch_size, shuffle=False),
+               False: data.DataLoader(subset, batch_size=opts.val_batch_size, shuffle=False)}
+    model = build_model(opts.model, head_classes(opts), opts.output_stride, opts.separable_conv).to(device)
+    metrics = DeviceSegMetrics(opts.num_classes, device=device)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        itrs, path, full = task
+        checkpoint = load_ckpt(path)
+        model.load_state_dict(checkpoint["model_state"])
+        del checkpoint
+        model.eval()
+        score, _ = validate(opts=opts, model=model, loader=loaders[full], device=device, metrics=metrics)
+        results.put((itrs, path, full, score))
+
+
+class AsyncValidator(object):
+    """Validate checkpoints in a separate process while training continues.
+
+    ``submit`` waits for the background write of a checkpoint, hard-links it
+    to a per-iteration snapshot and queues the snapshot for ``eval_worker``.
+    ``poll`` returns the results received so far, ``close`` waits for the
+    outstanding ones; results are (itrs, snapshot, full, score) tuples and
+    the caller owns the snapshot files.
+    """
+    def __init__(self, opts):
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        worker_opts = copy.copy(opts)
+        worker_opts.distributed = False
+        worker_opts.save_val_results = False
+        self.worker = ctx.Process(target=eval_worker, args=(worker_opts, self.tasks, self.results), daemon=True)
+        self.worker.start()
+        self.pending = 0
+
+    def submit(self, save_future, path, itrs, full):
+        root, ext = os.path.splitext(path)
+        snapshot = '%s_snapshot%d%s' % (root, itrs, ext)
+
+        def enqueue(future):
+            if future.exception() is not None:  # raised again by CheckpointWriter
+                self.results.put((itrs, None, full, None))
+                return
+            link_or_copy(path, snapshot)
+            self.tasks.put((itrs, snapshot, full))
+
+        self.pending += 1
+        save_future.add_done_callback(enqueue)
+
+    def poll(self):
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.pending -= len(done)
+        return done
+
+    def close(self):
+        done = []
+        while len(done) < self.pending:
+            try:
+                done.append(self.results.get(timeout=10))
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    print("[!] Evaluation worker exited, %d results lost" % (self.pending - len(done)))
+                    break
+        self.pending = 0
+        self.tasks.put(None)
+        self.worker.join(timeout=60)
+        return done
+
+
+def validate(opts, model, loader, device, metrics, ret_samples_ids=None, writer=None, profiler=None, itrs=0):
     print("validating")
     """Do validation and return specified samples"""
     metrics.reset()
     ret_samples = []
-    if opts.save_val_results:
-        if not os.path.exists(opts.save_val_results_path):
-            os.mkdir(opts.save_val_results_path)
+    pred_lut = prediction_lut(opts, device)
+    if writer is not None:
+        os.makedirs(opts.save_val_results_path, exist_ok=True)
         denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], 
                                    std=[0.229, 0.224, 0.225])
-        img_id = 0
+        dataset = loader.dataset
+        while isinstance(dataset, data.Subset):  # --val_subset rounds
+            dataset = dataset.dataset
+        decode_target = dataset.decode_target
+        order = iter(loader.sampler)  # dataset indices in loader order, val loaders do not shuffle
+        store, appends = None, []
+        if opts.save_format == 'store':  # one store per round, an append-only store is never compacted
+            name = 'val_itr%d' % itrs
+            if dist.is_available() and dist.is_initialized():  # every rank stores its own shard
+                name += '_rank%d' % dist.get_rank()
+            store = PredictionWriter(os.path.join(opts.save_val_results_path, name), codec=opts.store_codec)
 
     
+    from tqdm import tqdm
     with torch.no_grad():
         for i, (images, labels) in tqdm(enumerate(loader)):
-            
+            if profiler is not None:
+                profiler.step(i)
             images = images.to(device, dtype=torch.float32)
             labels = labels.to(device, dtype=torch.long)
 
-            outputs = model(images)
-            preds = outputs.detach().max(dim=1)[1].cpu().numpy()
-            targets = labels.cpu().numpy()
+            with autocast(opts, device):
+                outputs = predict(opts, model, images)
+            preds = outputs.detach().max(dim=1)[1]
+            if pred_lut is not None:
+                preds = pred_lut[preds]
 
-            metrics.update(targets, preds)
+            metrics.update(labels, preds)
             if ret_samples_ids is not None and i in ret_samples_ids:  # get vis samples
                 ret_samples.append(
-                    (images[0].detach().cpu().numpy(), targets[0], preds[0]))
-
-            if opts.save_val_results:
-                for i in range(len(images)):
-                    image = images[i].detach().cpu().numpy()
-                    target = targets[i]
-                    pred = preds[i]
-
-                    image = (denorm(image) * 255).transpose(1, 2, 0).astype(np.uint8)
-                    target = loader.dataset.decode_target(target).astype(np.uint8)
-                    pred = loader.dataset.decode_target(pred).astype(np.uint8)
-
-#                    Image.fromarray(image).save(os.path.join(opts.save_val_results_path,'%d_image.png' % img_id))
-#                    Image.fromarray(target).save(os.path.join(opts.save_val_results_path,'%d_target.png' % img_id))
-#                    Image.fromarray(pred).save(os.path.join(opts.save_val_results_path,'%d_pred.png' % img_id))
-
-                    fig = plt.figure()
-                    plt.imshow(image)
-                    plt.axis('off')
-                    plt.imshow(pred, alpha=0.7)
-                    ax = plt.gca()
-                    ax.xaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    ax.yaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    plt.savefig(os.path.join(opts.save_val_results_path,'%d_overlay.png' % img_id), bbox_inches='tight', pad_inches=0)
-                    plt.close()
-                    img_id += 1
-
+                    (images[0].detach().cpu().numpy(), labels[0].cpu().numpy(), preds[0].cpu().numpy()))
+
+            if writer is not None:
+                np_images = images.detach().cpu().numpy()
+                np_preds = preds.cpu().numpy()
+                for k in range(len(np_images)):
+                    # keyed by dataset index, so every round writes the same names
+                    img_id, source = base_sample(loader.dataset, next(order))
+                    if store is not None:
+                        appends.append(writer.submit(store.append, img_id, np_preds[k], source))
+                    else:
+                        writer.submit(save_val_overlay,
+                                      os.path.join(opts.save_val_results_path, '%d_overlay.png' % img_id),
+                                      np_images[k], np_preds[k], denorm, decode_target)
+
+        if profiler is not None:
+            profiler.close()
+        if writer is not None and store is not None:
+            for future in appends:  # errors are raised by writer.close()
+                future.exception()
+            store.close()
+        metrics.synchronize()
         score = metrics.get_results()
     return score, ret_samples
 
-def infer(opts, model, loader, device, metrics, ret_samples_ids=None):
-    """Do validation and return specified samples"""
+class BucketBatcher(object):
+    """Group images of similar size into batches for inference.
+
+    Each image joins the bucket of its size rounded up to ``multiple``. A
+    bucket is released once it holds ``max_batch`` images, or once its oldest
+    image has waited ``max_delay`` seconds. Released images are zero-padded
+    (the dataset mean after normalization) to the bucket size; ``sizes`` keeps
+    the original sizes to crop predictions back.
+    """
+    def __init__(self, max_batch, multiple=32, max_delay=None):
+        self.max_batch = max_batch
+        self.multiple = multiple
+        self.max_delay = max_delay
+        self.buckets = {}
+
+    def bucket_size(self, h, w):
+        m = self.multiple
+        return ((h + m - 1) // m * m, (w + m - 1) // m * m)
+
+    def add(self, image, meta):
+        """ queue a CxHxW image, returns the batches that became ready
+        """
+        h, w = image.shape[-2:]
+        key = self.bucket_size(h, w)
+        bucket = self.buckets.setdefault(key, {'start': time.perf_counter(), 'items': []})
+        bucket['items'].append((image, meta))
+        ready = []
+        now = time.perf_counter()
+        for key in list(self.buckets):
+            bucket = self.buckets[key]
+            if len(bucket['items']) >= self.max_batch or \
+                    (self.max_delay is not None and now - bucket['start'] >= self.max_delay):
+                ready.append(self._release(key))
+        return ready
+
+    def flush(self):
+        return [self._release(key) for key in list(self.buckets)]
+
+    def _release(self, key):
+        items = self.buckets.pop(key)['items']
+        batch = items[0][0].new_zeros((len(items), items[0][0].shape[0]) + key)
+        for k, (image, _) in enumerate(items):
+            batch[k, :, :image.shape[-2], :image.shape[-1]] = image
+        sizes = [tuple(image.shape[-2:]) for image, _ in items]
+        return batch, [meta for _, meta in items], sizes
+
+
+def infer(opts, model, loader, device, metrics, ret_samples_ids=None, writer=None, cache=None):
+    """Segment the test set in size-bucketed batches and return specified samples.
+
+    ``loader`` yields single (image, _) samples of a dataset with an
+    ``images`` file list; they are batched here by BucketBatcher so images of
+    different sizes never share a forward pass unpadded, and every prediction
+    is cropped back to its image. With an
+    InferenceCache, only images missing from it go through the model; cached
+    predictions are written out as if they had been computed.
+    """
     metrics.reset()
     ret_samples = []
-    if opts.save_val_results:
+    pred_lut = prediction_lut(opts, device)
+    if writer is not None:
         if not os.path.exists(opts.save_val_results_path):
             os.mkdir(opts.save_val_results_path)
         denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], 
                                    std=[0.229, 0.224, 0.225])
-        img_id = 0
-    
+    batcher = BucketBatcher(opts.val_batch_size, multiple=opts.bucket_multiple, max_delay=opts.batch_timeout)
+
+    def save(img_id, image, pred):
+        if writer.store is not None:
+            writer.store.append(img_id, pred, os.path.abspath(dataset.images[img_id]))
+        else:
+            save_test_results(os.path.join(opts.save_val_results_path, '%d' % img_id),
+                              image, pred, denorm, opts.class_map is not None)
+
+    def replay(img_id, key):
+        image = dataset[img_id][0].numpy() if writer.store is None else None
+        save(img_id, image, cache.get(key))
+
+    dataset = loader.dataset
+    img_ids = range(len(dataset))
+    cache_jobs = []  # replays read cache entries and puts add them, both before evict()
+    if cache is not None:
+        keys = [cache.key(path) for path in dataset.images]
+        img_ids = [img_id for img_id, key in enumerate(keys) if not cache.lookup(key)]
+        if writer is not None:
+            for img_id in sorted(set(range(len(dataset))) - set(img_ids)):
+                cache_jobs.append(writer.submit(replay, img_id, keys[img_id]))
+        loader = make_loader(opts, data.Subset(dataset, img_ids), None)
+
+    def run(images, metas, sizes):
+        images = images.to(device, dtype=torch.float32)
+        with autocast(opts, device):
+            outputs = predict(opts, model, images)
+        preds = outputs.detach().max(dim=1)[1]
+        if pred_lut is not None:
+            preds = pred_lut[preds]
+        preds = preds.cpu().numpy()
+        np_images = images.detach().cpu().numpy()
+        for k, (img_id, (h, w)) in enumerate(zip(metas, sizes)):
+            image, pred = np_images[k, :, :h, :w], preds[k, :h, :w]
+            if ret_samples_ids is not None and img_id in ret_samples_ids:  # get vis samples
+                ret_samples.append((image, pred))
+            if writer is not None:
+                writer.submit(save, img_id, image, pred)
+            if cache is not None and writer is not None:
+                cache_jobs.append(writer.submit(cache.put, keys[img_id], pred))
+            elif cache is not None:
+                cache.put(keys[img_id], pred)
+
+    from tqdm import tqdm
     with torch.no_grad():
-        for i, images in tqdm(enumerate(loader)):
-            
-            images = images[0].to(device, dtype=torch.float32)#.unsqueeze(0)
-            print(images.shape)
-            #labels = labels.to(device, dtype=torch.long)
-            
-            outputs = model(images)
-            preds = outputs.detach().max(dim=1)[1].cpu().numpy()
-            #targets = labels.cpu().numpy()
-            if ret_samples_ids is not None and i in ret_samples_ids:  # get vis samples
-                ret_samples.append(
-                            (images[0].detach().cpu().numpy(),  preds[0]))
-            if opts.save_val_results:
-                for i in range(len(images)):
-                    image = images[i].detach().cpu().numpy()
-                    pred = preds[i]
-                    image = (denorm(image) * 255).transpose(1, 2, 0).astype(np.uint8)
-                    print(pred.shape)
-                    #pred[pred == 255] = 19  #loader.dataset.decode_target(pred).astype(np.uint8)
-                    predfull = (pred==1) + (pred==1) + (pred == 9)  #merge road, sidewalk, terrain
-                    print("\n\n\n\n\n\n")
-                    print(type(predfull))
-                    Image.fromarray(predfull).save(os.path.join(opts.save_val_results_path,'%d_predfull.png' % img_id))
-                    Image.fromarray(image).save(os.path.join(opts.save_val_results_path,'%d_image.png' % img_id))
-                    print(type(image))
-                    
-#                    for category in range(0, 21):
-#                        predlocal = (pred==category)# + (pred==1) + (pred == 9)  #merge road, sidewalk, terrain
-#                        Image.fromarray(predlocal).save(os.path.join(opts.save_val_results_path,f'%d_pred{category}.png' % img_id))
-                    fig = plt.figure()
-                    plt.imshow(image)
-                    plt.axis('off')
-                    plt.imshow(predfull, alpha=0.7)
-                    ax = plt.gca()
-                    ax.xaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    ax.yaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    plt.savefig(os.path.join(opts.save_val_results_path,'%d_overlay.png' % img_id), bbox_inches='tight', pad_inches=0)
-                    plt.close()
-                    img_id += 1
+        for k, (image, _) in tqdm(enumerate(loader)):
+            for batch in batcher.add(image, img_ids[k]):
+                run(*batch)
+        for batch in batcher.flush():
+            run(*batch)
+    if cache is not None:
+        # eviction must not delete entries still to be replayed, new entries count
+        # toward max_bytes, and close(drop=True) must not cancel either; errors are
+        # raised by writer.close()
+        for future in cache_jobs:
+            future.exception()
+        cache.evict()
+        print(cache.summary())
     return ret_samples
 
 
@@ -373,110 +1440,222 @@ def a():
 
 
 def main():
+    startup = [('imports', time.perf_counter())]
     opts = get_argparser().parse_args()
-    if opts.dataset.lower() == 'voc':
-        opts.num_classes = 21
-    elif opts.dataset.lower() == 'cityscapes':
-        opts.num_classes = 19 #TODO:read cat
+    inferring = opts.test_only or opts.stream is not None
+    opts.num_classes = DATASET_CLASSES[opts.dataset.lower()] #TODO:read cat
+    if opts.class_map is not None:
+        _, opts.num_classes = load_class_map(opts.class_map)
+        print("Class map %s: %d classes" % (opts.class_map, opts.num_classes))
+
+    if not opts.distributed:
+        os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
+    rank, world_size, local_rank = init_distributed(opts)
+    if opts.distributed and torch.cuda.is_available():
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("Device: %s, Rank: %d/%d" % (device, rank, world_size))
 
     # Setup visualization
-    vis = Visualizer(port=opts.vis_port,
-                     env=opts.vis_env) if opts.enable_vis else None
+    vis = None
+    if opts.enable_vis and is_main_process():
+        from utils.visualizer import Visualizer
+        vis = Visualizer(port=opts.vis_port, env=opts.vis_env)
     if vis is not None:  # display options
         vis.vis_table("Options", vars(opts))
+    if opts.tile_size is not None and not 0 <= opts.tile_overlap < opts.tile_size:
+        raise ValueError("--tile_overlap must be in [0, --tile_size)")
+    if opts.accum_steps < 1:
+        raise ValueError("--accum_steps must be at least 1")
+    if opts.precision == 'fp16' and device.type != 'cuda':
+        raise ValueError("fp16 autocast needs CUDA, use --precision bf16 on CPU")
+
+    if opts.benchmark:
+        from benchmark import run_benchmark
+        opts.bench_models = opts.bench_models or list(MODEL_MAP)
+        run_benchmark(opts, device, build_model, autocast)
+        return
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print("Device: %s" % device)
-
-    # Setup random seed
-    torch.manual_seed(opts.random_seed)
-    np.random.seed(opts.random_seed)
-    random.seed(opts.random_seed)
+    # Setup random seed, offset per rank so augmentations differ across processes
+    torch.manual_seed(opts.random_seed + rank)
+    np.random.seed(opts.random_seed + rank)
+    random.seed(opts.random_seed + rank)
+    batch_aug = None
+    if opts.batch_aug:
+        scale_range, jitter = BATCH_AUG[opts.dataset]
+        batch_aug = BatchAugment(opts.crop_size, scale_range=scale_range, jitter=jitter,
+                                 seed=opts.random_seed + rank)
 
     # Setup dataloader
-    if opts.dataset=='voc' and not opts.crop_val:
+    if opts.dataset=='voc' and not opts.crop_val and not opts.test_only and opts.stream is None:
         opts.val_batch_size = 1
 
-    train_dst, val_dst, test_dst = get_dataset(opts)
+    if opts.test_only:
+        splits = ('test',)
+    elif opts.stream is not None:
+        splits = ()  # frames come from --stream
+    else:
+        splits = ('train', 'val')
+    train_dst, val_dst, test_dst = get_dataset(opts, splits)
     #clusterize(train_dst)
 
     print(train_dst)
-    train_loader = data.DataLoader(
-        train_dst, batch_size=opts.batch_size, shuffle=True, num_workers=2)
+    train_sampler = data.DistributedSampler(train_dst, shuffle=True) \
+        if opts.distributed and train_dst is not None else None
+    val_sampler = ShardSampler(val_dst) if opts.distributed and val_dst is not None else None
+    if opts.val_subset is not None and val_dst is not None:
+        subset_dst = data.Subset(val_dst, val_subset_indices(len(val_dst), opts.val_subset))
+        subset_sampler = ShardSampler(subset_dst) if opts.distributed else None
+
+    def build_loaders():
+        if train_dst is None:
+            train_loader = val_loader = subset_loader = None
+        else:
+            train_loader = make_loader(opts, train_dst, opts.batch_size, shuffle=True, sampler=train_sampler)
+            val_loader = make_loader(opts, val_dst, opts.val_batch_size, sampler=val_sampler)
+            subset_loader = make_loader(opts, subset_dst, opts.val_batch_size, sampler=subset_sampler) \
+                if opts.val_subset is not None else None
+        # unbatched, infer() buckets images by size
+        test_loader = make_loader(opts, test_dst, None) if test_dst is not None else None
+        return train_loader, val_loader, subset_loader, test_loader
+
+    autotune = opts.num_workers == 'auto'
+    opts.num_workers = 2 if autotune else int(opts.num_workers)
+    train_loader, val_loader, subset_loader, test_loader = build_loaders()
     print(train_loader)
-    val_loader = data.DataLoader(
-        val_dst, batch_size=opts.val_batch_size, shuffle=True, num_workers=2)
-    test_loader = data.DataLoader(
-        test_dst, batch_size=opts.val_batch_size, shuffle=False, num_workers=2)
     
-    print("Dataset: %s, Train set: %d, Val set: %d Test set: %d" %
-          (opts.dataset, len(train_dst), len(val_dst), len(test_dst)))
+    print("Dataset: %s, %s" % (opts.dataset, ', '.join(
+        '%s set: %d' % (name, len(dst)) for name, dst in
+        (('Train', train_dst), ('Val', val_dst), ('Test', test_dst)) if dst is not None)))
+    startup.append(('data', time.perf_counter()))
 
 
     # Set up model
-    model_map = {
-        'deeplabv3_resnet50': network.deeplabv3_resnet50,
-        'deeplabv3plus_resnet50': network.deeplabv3plus_resnet50,
-        'deeplabv3_resnet101': network.deeplabv3_resnet101,
-        'deeplabv3plus_resnet101': network.deeplabv3plus_resnet101,
-        'deeplabv3_mobilenet': network.deeplabv3_mobilenet,
-        'deeplabv3plus_mobilenet': network.deeplabv3plus_mobilenet
-    }
-
-    model = model_map[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride)
-    if opts.separable_conv and 'plus' in opts.model:
-        network.convert_to_separable_conv(model.classifier)
-    utils.set_bn_momentum(model.backbone, momentum=0.01)
+    model = build_model(opts.model, head_classes(opts), opts.output_stride, opts.separable_conv)
+    if opts.grad_checkpoint and not inferring:
+        print("Activation checkpointing of %d modules" % enable_grad_checkpoint(model))
+    startup.append(('model', time.perf_counter()))
     
     # Set up metrics
-    metrics = StreamSegMetrics(opts.num_classes)
-
-    # Set up optimizer
-    optimizer = torch.optim.SGD(params=[
-        {'params': model.backbone.parameters(), 'lr': 0.1*opts.lr},
-        {'params': model.classifier.parameters(), 'lr': opts.lr},
-    ], lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
-    #optimizer = torch.optim.SGD(params=model.parameters(), lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
-    #torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.lr_decay_step, gamma=opts.lr_decay_factor)
-    if opts.lr_policy=='poly':
-        scheduler = utils.PolyLR(optimizer, opts.total_itrs, power=0.9)
-    elif opts.lr_policy=='step':
-        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.step_size, gamma=0.1)
-
-    # Set up criterion
-    #criterion = utils.get_loss(opts.loss_type)
-    if opts.loss_type == 'focal_loss':
-        criterion = utils.FocalLoss(ignore_index=255, size_average=True)
-    elif opts.loss_type == 'cross_entropy':
-        criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+    metrics = DeviceSegMetrics(opts.num_classes, device=device)
+    writer = None
+    if opts.save_val_results and (is_main_process() or not inferring):  # every rank saves its val shard
+        # --test_only writes one store, validation one per round (see validate)
+        store = PredictionWriter(opts.save_val_results_path, codec=opts.store_codec) \
+            if opts.save_format == 'store' and opts.test_only else None
+        writer = ResultWriter(opts.save_workers, opts.save_queue_size, store=store)
+
+    # Set up optimizer, scheduler, criterion and scaler, which inference has no use for
+    optimizer = scheduler = criterion = scaler = None
+    if not inferring:
+        optimizer = torch.optim.SGD(params=[
+            {'params': model.backbone.parameters(), 'lr': 0.1*opts.lr},
+            {'params': model.classifier.parameters(), 'lr': opts.lr},
+        ], lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
+        #optimizer = torch.optim.SGD(params=model.parameters(), lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
+        #torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.lr_decay_step, gamma=opts.lr_decay_factor)
+        if opts.lr_policy=='poly':
+            scheduler = utils.PolyLR(optimizer, opts.total_itrs, power=0.9)
+        elif opts.lr_policy=='step':
+            scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=opts.step_size, gamma=0.1)
+
+        # Set up criterion
+        #criterion = utils.get_loss(opts.loss_type)
+        if opts.loss_type == 'focal_loss':
+            criterion = utils.FocalLoss(ignore_index=255, size_average=True)
+        elif opts.loss_type == 'cross_entropy':
+            criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+
+        # fp16 gradients can underflow, bf16 has the fp32 exponent range and needs no scaling
+        scaler = torch.cuda.amp.GradScaler(enabled=opts.precision == 'fp16')
+
+    ckpt_writer = CheckpointWriter(keep=opts.ckpt_keep)
 
     def save_ckpt(path):
-        """ save current model
+        """ save current model in the background, from rank 0 only
         """
-        torch.save({
+        if not is_main_process():
+            return None
+        return ckpt_writer.save({
             "cur_itrs": cur_itrs,
-            "model_state": model.module.state_dict(),
+            "model_state": model.module.state_dict(),  # the eager network, also with --compile
             "optimizer_state": optimizer.state_dict(),
             "scheduler_state": scheduler.state_dict(),
+            "scaler_state": scaler.state_dict(),
             "best_score": best_score,
-        }, path)
-        print("Model saved as %s" % path)
+        }, path, itrs=cur_itrs)
+
+    def shutdown():
+        """ release background workers before leaving main()
+        """
+        ckpt_writer.wait()  # queues the last snapshots for async_val
+        if async_val is not None:
+            for itrs, snapshot, full, score in async_val.close():
+                on_val_result(itrs, score, full, snapshot=snapshot)
+        ckpt_writer.close()  # after the best checkpoints on_val_result saved
+        if writer is not None:
+            writer.close(drop=opts.drop_save_results)
+        if meter is not None:
+            meter.close()
+        if profiler is not None:
+            profiler.close()
+        if opts.distributed:
+            dist.destroy_process_group()
     
-    utils.mkdir('checkpoints')
+    def on_val_result(itrs, score, full, ret_samples=(), snapshot=None):
+        """ report a validation round, a better full validation becomes best_*.pth
+        """
+        nonlocal best_score
+        if score is None:  # the snapshot could not be written
+            return
+        print("%s validation at Itrs %d:" % ('Full' if full else 'Subset', itrs))
+        print(metrics.to_str(score))
+        if full and score['Mean IoU'] > best_score:  # save best model
+            best_score = score['Mean IoU']
+            best_path = 'checkpoints/best_%s_%s_os%d.pth' % (opts.model, opts.dataset, opts.output_stride)
+            if snapshot is None:
+                save_ckpt(best_path)
+            else:  # the snapshot was saved before this validation, record its score
+                checkpoint = torch.load(snapshot, map_location=torch.device('cpu'))
+                checkpoint['best_score'] = best_score
+                ckpt_writer.save(checkpoint, best_path, itrs=checkpoint['cur_itrs'])
+                del checkpoint
+        if snapshot is not None:
+            os.remove(snapshot)
+
+        if vis is not None:  # visualize validation score and samples
+            vis.vis_scalar("[Val] Overall Acc", itrs, score['Overall Acc'])
+            vis.vis_scalar("[Val] Mean IoU", itrs, score['Mean IoU'])
+            vis.vis_table("[Val] Class IoU", score['Class IoU'])
+
+            for k, (img, target, lbl) in enumerate(ret_samples):
+                img = (denorm(img) * 255).astype(np.uint8)
+                target = train_dst.decode_target(target).transpose(2, 0, 1).astype(np.uint8)
+                lbl = train_dst.decode_target(lbl).transpose(2, 0, 1).astype(np.uint8)
+                concat_img = np.concatenate((img, target, lbl), axis=2)  # concat along width
+                vis.vis_image('Sample %d' % k, concat_img)
+
+    if not inferring:
+        utils.mkdir('checkpoints')
+    meter = None
+    profiler = val_profiler = None
+    async_val = None
     # Restore
     best_score = 0.0
     cur_itrs = 0
     cur_epochs = 0
     if opts.ckpt is not None and os.path.isfile(opts.ckpt):
         # https://github.com/VainF/DeepLabV3Plus-Pytorch/issues/8#issuecomment-605601402, @PytaichukBohdan
-        checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
+        checkpoint = load_ckpt(opts.ckpt)
         model.load_state_dict(checkpoint["model_state"])
-        model = nn.DataParallel(model)
-        model.to(device)
-        if opts.continue_training:
+        model = parallelize(opts, model, device, train=not inferring)
+        if opts.continue_training and not inferring:
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             scheduler.load_state_dict(checkpoint["scheduler_state"])
+            if checkpoint.get("scaler_state") and scaler.is_enabled():
+                scaler.load_state_dict(checkpoint["scaler_state"])
             cur_itrs = checkpoint["cur_itrs"]
             best_score = checkpoint['best_score']
             print("Training state restored from %s" % opts.ckpt)
@@ -485,30 +1664,100 @@ def main():
     else:
         print(opts.ckpt)
         print("[!] Retrain")
-        model = nn.DataParallel(model)
-        model.to(device)
+        model = parallelize(opts, model, device, train=not inferring)
+    startup.append(('checkpoint', time.perf_counter()))
+
+    if autotune and opts.stream is None:
+        def probe_step(batch):
+            images = batch[0] if batch[0].dim() == 4 else batch[0][None]
+            images = images.to(device)
+            if batch_aug is not None and not opts.test_only:
+                images, _ = batch_aug(images, batch[1].to(device), batch[2])
+            with torch.no_grad(), autocast(opts, device):
+                model(images.float())
+
+        aug_state = batch_aug.generator.get_state() if batch_aug is not None else None
+        model.eval()
+        if opts.test_only:
+            autotune_loader(opts, test_dst, None, probe_step)
+        else:
+            autotune_loader(opts, train_dst, opts.batch_size, probe_step, shuffle=True, sampler=train_sampler)
+        model.train()
+        if aug_state is not None:
+            batch_aug.generator.set_state(aug_state)
+        train_loader, val_loader, subset_loader, test_loader = build_loaders()
+        startup.append(('autotune', time.perf_counter()))
+
+    if opts.compile and (not inferring or is_main_process()):
+        compile_model(opts, model)
+        warmup_model(opts, model, device, train=not inferring)
+        startup.append(('compile', time.perf_counter()))
 
     #==========   Train Loop   ==========#
     vis_sample_id = np.random.randint(0, len(val_loader), opts.vis_num_samples,
-                                      np.int32) if opts.enable_vis else None  # sample idxs for visualization
+                                      np.int32) if opts.enable_vis and val_loader is not None else None  # sample idxs for visualization
     denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])  # denormalization for ori images
 
+    if opts.stream is not None:
+        if is_main_process():
+            model.eval()
+            pred_lut = prediction_lut(opts, device)
+            decode_target = {'voc': VOCSegmentation, 'cityscapes': Cityscapes}[opts.dataset].decode_target
+
+            def segment(images):
+                with torch.no_grad(), autocast(opts, device):
+                    preds = predict(opts, model, images).max(dim=1)[1]
+                return pred_lut[preds] if pred_lut is not None else preds
+
+            def overlay(frame, pred):
+                return blend_overlay(frame, decode_target(pred).astype(np.uint8))
+            report_startup(startup, opts.startup_budget)
+            run_stream(opts, segment, device, overlay if opts.stream_overlay else None)
+        shutdown()
+        return
+
     if opts.test_only:
+        if not is_main_process():  # test results are written by rank 0 alone
+            shutdown()
+            return
         model.eval()
-        opts.val_batch_size = 1
-        ret_samples = infer(opts=opts, model=model, loader=test_loader, device=device, metrics=metrics)
-
+        cache = None
+        if opts.infer_cache is not None and opts.ckpt is not None and os.path.isfile(opts.ckpt):
+            from infer_cache import InferenceCache, inference_settings
+            cache = InferenceCache(opts.infer_cache, opts.ckpt, inference_settings(opts),
+                                   max_bytes=int(opts.infer_cache_size * 2**20))
+        elif opts.infer_cache is not None:
+            print("[!] --infer_cache needs a --ckpt to fingerprint, running without it")
+        report_startup(startup, opts.startup_budget)
+        ret_samples = infer(opts=opts, model=model, loader=test_loader, device=device, metrics=metrics,
+                            writer=writer, cache=cache)
+        shutdown()
         return
 
     interval_loss = 0
+    step_loss, step_images, micro_steps = 0, 0, 0
+    optimizer.zero_grad()
+    val_round = 0
+    meter = ThroughputMeter(device, enabled=opts.perf_stats, log_path=opts.perf_log)
+    if opts.profile_steps is not None and is_main_process():  # ranks would overwrite one trace
+        from profiling import StepProfiler
+        profiler = StepProfiler(model, device, opts.profile_steps, opts.profile_dir, tag=opts.profile_phase)
+        if opts.profile_phase == 'val':
+            profiler, val_profiler = None, profiler
+    if opts.async_val and is_main_process():
+        async_val = AsyncValidator(opts)
+    report_startup(startup, opts.startup_budget)
 #    number = 0
     while True: #cur_itrs < opts.total_itrs:
         # =====  Train  =====
         model.train()
         cur_epochs += 1
-        for (images, labels) in train_loader:
+        if train_sampler is not None:
+            train_sampler.set_epoch(cur_epochs)
+        for (images, labels, *sizes) in train_loader:  # sizes of RawCropDataset windows
 #            number+=1
-            cur_itrs += 1
+            if profiler is not None and micro_steps % opts.accum_steps == 0:
+                profiler.step(cur_itrs)  # at the first micro-batch of an optimizer step
 #            debug_info(images)
 #            print(images.shape)
 #            debug_info(labels[0].float()/20)
@@ -543,55 +1792,76 @@ def main():
 #            save_image(images[0].float(), f"labels/test_mix.png")
 #            save_image(labels[0].float()/20, f"labels/test_label_2_swap.png")
             
-            images = images.to(device, dtype=torch.float32)
-            labels = labels.to(device, dtype=torch.long)
+            if batch_aug is not None:  # uint8 crops, 4x less to copy than float
+                images, labels = batch_aug(images.to(device, non_blocking=True),
+                                           labels.to(device, non_blocking=True), sizes[0])
+            else:
+                images = images.to(device, dtype=torch.float32)
+                labels = labels.to(device, dtype=torch.long)
+            images = to_model_format(opts, images)
             #debug_info(images)
+            meter.mark('data')
+
+            micro_steps += 1
+            accumulating = micro_steps % opts.accum_steps != 0
+            # DDP all-reduces gradients on the last micro-batch of a step only
+            sync = model.no_sync() if accumulating and opts.distributed else contextlib.nullcontext()
+            with sync:
+                with autocast(opts, device):
+                    outputs = model(images)
+                    loss = criterion(outputs, labels)
+                meter.mark('forward')
+                scaler.scale(loss / opts.accum_steps).backward()
+            meter.mark('backward')
+            step_loss += loss.detach() / opts.accum_steps  # stays on device, no sync per itr
+            step_images += images.size(0)
+            if accumulating:
+                continue
 
+            cur_itrs += 1
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            meter.mark('step')
+            meter.update(step_images)
 
-            np_loss = loss.detach().cpu().numpy()
-            interval_loss += np_loss
+            interval_loss += step_loss
             if vis is not None:
-                vis.vis_scalar('Loss', cur_itrs, np_loss)
+                vis.vis_scalar('Loss', cur_itrs, step_loss.item())
+            step_loss, step_images = 0, 0
 
-            if (cur_itrs) % 10 == 0:
-                interval_loss = interval_loss/10
+            if (cur_itrs) % opts.print_interval == 0:
+                interval_loss = interval_loss.item()/opts.print_interval
                 print("Epoch %d, Itrs %d/%d, Loss=%f" %
                       (cur_epochs, cur_itrs, opts.total_itrs, interval_loss))
+                meter.report(epoch=cur_epochs, itrs=cur_itrs, loss=interval_loss)
                 interval_loss = 0.0
 
             if (cur_itrs) % opts.val_interval == 0:
-                save_ckpt('checkpoints/latest_%s_%s_os%d.pth' %
-                          (opts.model, opts.dataset, opts.output_stride))
-                print("validation...")
-                model.eval()
-                val_score, ret_samples = validate(
-                    opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id)
-                print(metrics.to_str(val_score))
-                if val_score['Mean IoU'] > best_score:  # save best model
-                    best_score = val_score['Mean IoU']
-                    save_ckpt('checkpoints/best_%s_%s_os%d.pth' %
-                              (opts.model, opts.dataset,opts.output_stride))
-
-                if vis is not None:  # visualize validation score and samples
-                    vis.vis_scalar("[Val] Overall Acc", cur_itrs, val_score['Overall Acc'])
-                    vis.vis_scalar("[Val] Mean IoU", cur_itrs, val_score['Mean IoU'])
-                    vis.vis_table("[Val] Class IoU", val_score['Class IoU'])
-
-                    for k, (img, target, lbl) in enumerate(ret_samples):
-                        img = (denorm(img) * 255).astype(np.uint8)
-                        target = train_dst.decode_target(target).transpose(2, 0, 1).astype(np.uint8)
-                        lbl = train_dst.decode_target(lbl).transpose(2, 0, 1).astype(np.uint8)
-                        concat_img = np.concatenate((img, target, lbl), axis=2)  # concat along width
-                        vis.vis_image('Sample %d' % k, concat_img)
-                model.train()
+                latest = 'checkpoints/latest_%s_%s_os%d.pth' % (opts.model, opts.dataset, opts.output_stride)
+                save_future = save_ckpt(latest)
+                val_round += 1
+                full = opts.val_subset is None or \
+                    (opts.full_val_every > 0 and val_round % opts.full_val_every == 0)
+                if async_val is not None:
+                    async_val.submit(save_future, latest, cur_itrs, full)
+                elif not opts.async_val:  # with async_val, ranks other than 0 skip validation
+                    print("validation...")
+                    model.eval()
+                    val_score, ret_samples = validate(
+                        opts=opts, model=model, loader=val_loader if full else subset_loader, device=device,
+                        metrics=metrics, ret_samples_ids=vis_sample_id, writer=writer, profiler=val_profiler,
+                        itrs=cur_itrs)
+                    on_val_result(cur_itrs, val_score, full, ret_samples)
+                    model.train()
+                meter.restart()  # checkpoint and validation time is not data wait
+            if async_val is not None:
+                for itrs, snapshot, full, score in async_val.poll():
+                    on_val_result(itrs, score, full, snapshot=snapshot)
             scheduler.step()  
 
             if cur_itrs >=  opts.total_itrs:
+                shutdown()
                 return
 
 def debug_info(img):
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from PIL import Image
+from torch.utils import data
+
+INDEX_NAME = 'index.json'
+CACHE_VERSION = 1
+
+
+def _sources(dataset):
+    """ (image path, label path) pairs of a VOCSegmentation or Cityscapes dataset
+    """
+    labels = dataset.masks if hasattr(dataset, 'masks') else dataset.targets
+    return list(zip(dataset.images, labels))
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _describe(path, verify):
+    st = os.stat(path)
+    desc = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+    if verify == 'hash':
+        desc['sha1'] = _file_hash(path)
+    return desc
+
+
+def _is_stale(desc, verify):
+    """ whether a source changed since it was cached; a 'hash' check of an
+    index built with 'stat' falls back to stat and records the hash in desc
+    """
+    try:
+        st = os.stat(desc['path'])
+    except OSError:
+        return True
+    if st.st_size != desc['size']:
+        return True
+    if verify == 'hash' and 'sha1' in desc:
+        return desc['sha1'] != _file_hash(desc['path'])
+    if st.st_mtime != desc['mtime']:
+        return True
+    if verify == 'hash':
+        desc['sha1'] = _file_hash(desc['path'])
+    return False
+
+
+def build_cache(dataset, cache_dir, shard_bytes=1 << 30, verify='stat'):
+    """Decode every image and label map of ``dataset`` once and pack them as
+    raw uint8 arrays into shard files under ``cache_dir``, plus a JSON index of
+    offsets, shapes and source file stats.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    samples = []
+    shard_id, shard, shard_size = -1, None, shard_bytes
+    for img_path, lbl_path in _sources(dataset):
+        img = np.asarray(Image.open(img_path).convert('RGB'), dtype=np.uint8)
+        lbl = np.asarray(Image.open(lbl_path), dtype=np.uint8)
+        if shard_size + img.nbytes + lbl.nbytes > shard_bytes and shard_size > 0:
+            if shard is not None:
+                shard.close()
+            shard_id += 1
+            shard = open(os.path.join(cache_dir, 'shard_%04d.bin' % shard_id), 'wb')
+            shard_size = 0
+        entry = {'shard': shard_id, 'sources': [_describe(img_path, verify), _describe(lbl_path, verify)]}
+        for key, arr in (('image', img), ('label', lbl)):
+            entry[key] = {'offset': shard_size, 'shape': list(arr.shape)}
+            shard.write(arr.tobytes())
+            shard_size += arr.nbytes
+        samples.append(entry)
+    if shard is not None:
+        shard.close()
+
+    # the index is written last, so an interrupted build is never picked up
+    _write_index(cache_dir, {'version': CACHE_VERSION, 'verify': verify,
+                             'num_shards': shard_id + 1, 'samples': samples})
+
+
+def _write_index(cache_dir, index):
+    tmp = os.path.join(cache_dir, INDEX_NAME + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(cache_dir, INDEX_NAME))
+
+
+class MemmapSegmentation(data.Dataset):
+    """Segmentation dataset served from shards written by ``build_cache``.
+
+    Shards are opened as read-only ``np.memmap`` in each worker on first use,
+    so images are read straight from the page cache shared by all DataLoader
+    workers and never decoded again. The wrapped dataset only provides the
+    source file list, ``decode_target`` and, for Cityscapes, ``encode_target``.
+
+    Args:
+        dataset: VOCSegmentation or Cityscapes instance to cache.
+        cache_dir: directory of the shards; built on first use.
+        transform: joint image/label transform, as for the wrapped dataset.
+        verify: 'stat' checks source size and mtime, 'hash' also checks
+            content, 'none' trusts the cache.
+    """
+    def __init__(self, dataset, cache_dir, transform=None, verify='stat', shard_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.transform = transform
+        self.encode_target = getattr(dataset, 'encode_target', None)
+        self.decode_target = dataset.decode_target
+
+        index_path = os.path.join(cache_dir, INDEX_NAME)
+        if not os.path.isfile(index_path):
+            print("Building dataset cache in %s" % cache_dir)
+            build_cache(dataset, cache_dir, shard_bytes=shard_bytes,
+                        verify='hash' if verify == 'hash' else 'stat')
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') != CACHE_VERSION:
+            raise RuntimeError("Dataset cache %s has version %s, expected %d; delete it to rebuild"
+                               % (cache_dir, index.get('version'), CACHE_VERSION))
+        self.samples = index['samples']
+        self.num_shards = index['num_shards']
+        self._check(dataset, verify)
+        if verify == 'hash' and index.get('verify') != 'hash':  # keep the hashes _check filled in
+            index['verify'] = 'hash'
+            _write_index(cache_dir, index)
+        self._shards = None
+
+    def _check(self, dataset, verify):
+        sources = [os.path.abspath(p) for pair in _sources(dataset) for p in pair]
+        cached = [desc['path'] for sample in self.samples for desc in sample['sources']]
+        if sources != cached:
+            raise RuntimeError("Dataset cache %s does not match the dataset file list; delete it to rebuild"
+                               % self.cache_dir)
+        if verify == 'none':
+            return
+        for sample in self.samples:
+            for desc in sample['sources']:
+                if _is_stale(desc, verify):
+                    raise RuntimeError("Dataset cache %s is stale: %s changed; delete it to rebuild"
+                                       % (self.cache_dir, desc['path']))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None  # every worker maps the shards itself
+        return state
+
+    def _array(self, sample, key):
+        if self._shards is None:
+            self._shards = [np.memmap(os.path.join(self.cache_dir, 'shard_%04d.bin' % i),
+                                      dtype=np.uint8, mode='r')
+                            for i in range(self.num_shards)]
+        meta = sample[key]
+        count = int(np.prod(meta['shape']))
+        buf = self._shards[sample['shard']]
+        return buf[meta['offset']:meta['offset'] + count].reshape(meta['shape'])
+
+    def load(self, index):
+        """ raw (image HxWx3, label HxW) uint8 arrays, views into the shard
+        """
+        sample = self.samples[index]
+        return self._array(sample, 'image'), self._array(sample, 'label')
+
+    def __getitem__(self, index):
+        img, target = self.load(index)
+        img, target = Image.fromarray(img), Image.fromarray(target)
+        if self.transform is not None:
+            img, target = self.transform(img, target)
+        if self.encode_target is not None:
+            target = self.encode_target(target)
+        return img, target
+
+    def __len__(self):
+        return len(self.samples)
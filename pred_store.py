@@ -0,0 +1,180 @@
+"""Append-only store of predicted class maps, and an overlay renderer for it.
+
+Usage: python pred_store.py --store results/ --output_dir overlays/ [--ids 0 5 7]
+"""
+import argparse
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+from PIL import Image
+
+INDEX_NAME = 'index.jsonl'
+CODECS = ('zlib', 'raw')
+
+
+def _shard_path(root, shard_id):
+    return os.path.join(root, 'shard_%04d.bin' % shard_id)
+
+
+def _read_index(root):
+    """ index entries in write order, ignoring a line cut short by a crash
+    """
+    path = os.path.join(root, INDEX_NAME)
+    if not os.path.isfile(path):
+        return []
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.endswith('\n'):
+                entries.append(json.loads(line))
+    return entries
+
+
+class PredictionWriter(object):
+    """Append uint8 class maps to shard files under ``root``, one JSON line
+    per map in ``index.jsonl`` with its shard, byte offset, size and shape.
+
+    A map is written to its shard before its index line, so readers never see
+    a partial record; reopening a store continues after its last indexed
+    record, dropping any bytes an interrupted run left behind. ``append`` is
+    thread-safe, so ResultWriter threads can share one writer.
+
+    Args:
+        root: store directory, created if needed.
+        codec: 'zlib' compresses every map (class maps shrink a lot), 'raw'
+            keeps them as is so the reader can return memmap views.
+        shard_bytes: size after which a new shard file is started.
+    """
+    def __init__(self, root, codec='zlib', shard_bytes=1 << 30):
+        if codec not in CODECS:
+            raise ValueError("Unknown codec %s, expected one of %s" % (codec, CODECS))
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.codec = codec
+        self.shard_bytes = shard_bytes
+        self.lock = threading.Lock()
+
+        entries = _read_index(root)
+        index_path = os.path.join(root, INDEX_NAME)
+        if os.path.isfile(index_path):  # drop a trailing partial line
+            with open(index_path, 'r+b') as f:
+                content = f.read()
+                f.truncate(content.rfind(b'\n') + 1)
+        self.index = open(index_path, 'a')
+        self.shard = None
+        if entries:
+            last = entries[-1]
+            self._open(last['shard'], last['offset'] + last['nbytes'])
+        else:
+            self._open(0, 0)
+
+    def _open(self, shard_id, size):
+        if self.shard is not None:
+            self.shard.close()
+        path = _shard_path(self.root, shard_id)
+        self.shard = open(path, 'r+b' if os.path.isfile(path) else 'wb')
+        self.shard.truncate(size)
+        self.shard.seek(size)
+        self.shard_id, self.size = shard_id, size
+
+    def append(self, key, pred, source=None):
+        """ store the HxW class map ``pred`` under ``key``, a later one replacing it
+        """
+        pred = np.ascontiguousarray(pred, dtype=np.uint8)
+        payload = pred.tobytes()
+        if self.codec == 'zlib':
+            payload = zlib.compress(payload, 1)
+        with self.lock:
+            if self.size > 0 and self.size + len(payload) > self.shard_bytes:
+                self._open(self.shard_id + 1, 0)
+            entry = {'id': str(key), 'shard': self.shard_id, 'offset': self.size, 'nbytes': len(payload),
+                     'shape': list(pred.shape), 'codec': self.codec, 'source': source}
+            self.shard.write(payload)
+            self.shard.flush()
+            self.index.write(json.dumps(entry) + '\n')
+            self.index.flush()
+            self.size += len(payload)
+
+    def close(self):
+        with self.lock:
+            self.shard.close()
+            self.index.close()
+
+
+class PredictionStore(object):
+    """Random access to the class maps of a store written by PredictionWriter.
+
+    ``store[image_id]`` returns the HxW uint8 map; shards are mapped read-only
+    on first use, so 'raw' maps are served straight from the page cache.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.entries = {entry['id']: entry for entry in _read_index(root)}
+        self._shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}  # every worker maps the shards itself
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return str(key) in self.entries
+
+    def keys(self):
+        return list(self.entries)
+
+    def source(self, key):
+        """ path of the image the map was predicted from, if it was recorded
+        """
+        return self.entries[str(key)].get('source')
+
+    def __getitem__(self, key):
+        entry = self.entries[str(key)]
+        shard_id = entry['shard']
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(_shard_path(self.root, shard_id), dtype=np.uint8, mode='r')
+        buf = self._shards[shard_id][entry['offset']:entry['offset'] + entry['nbytes']]
+        if entry['codec'] == 'zlib':
+            buf = np.frombuffer(zlib.decompress(buf), dtype=np.uint8)
+        return buf.reshape(entry['shape'])
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="Render color overlays of a prediction store")
+    parser.add_argument("--store", type=str, required=True,
+                        help="store directory written with --save_format store")
+    parser.add_argument("--output_dir", type=str, default='./overlays/',
+                        help="where to write <id>_overlay.png")
+    parser.add_argument("--ids", type=str, nargs='*', default=None,
+                        help="image ids to render (default: all)")
+    parser.add_argument("--dataset", type=str, default='voc', choices=['voc', 'cityscapes'],
+                        help="color map of the classes (default: voc)")
+    return parser
+
+
+def main():
+    from datasets import VOCSegmentation, Cityscapes
+    from main import blend_overlay
+
+    opts = get_argparser().parse_args()
+    decode_target = {'voc': VOCSegmentation, 'cityscapes': Cityscapes}[opts.dataset].decode_target
+    store = PredictionStore(opts.store)
+    os.makedirs(opts.output_dir, exist_ok=True)
+    for key in (opts.ids if opts.ids is not None else store.keys()):
+        pred = np.array(store[key])
+        mask = decode_target(pred).astype(np.uint8)
+        source = store.source(key)
+        if source is not None and os.path.isfile(source):  # blend over the image when it is still around
+            image = np.asarray(Image.open(source).convert('RGB').resize(pred.shape[::-1]))
+            mask = blend_overlay(image, mask)
+        Image.fromarray(mask).save(os.path.join(opts.output_dir, '%s_overlay.png' % key))
+
+
+if __name__ == '__main__':
+    main()
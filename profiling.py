@@ -0,0 +1,176 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+
+def parse_steps(spec):
+    """ 'A:B' -> (A, B), iterations A to B-1 counted from 0 like a slice
+    """
+    try:
+        start, stop = (int(x) for x in spec.split(':'))
+    except ValueError:
+        raise ValueError("--profile_steps must look like A:B, got %r" % spec)
+    if not 0 <= start < stop:
+        raise ValueError("--profile_steps A:B needs 0 <= A < B, got %r" % spec)
+    return start, stop
+
+
+def profiled_modules(model):
+    """ (name, module) of the backbone and classifier children, and of ASPP
+    modules nested deeper, as in the DeepLabV3 head
+    """
+    from network._deeplab import ASPP
+    children = [('backbone.' + name, m) for name, m in model.backbone.named_children()]
+    children += [('classifier.' + name, m) for name, m in model.classifier.named_children()]
+    direct = set(id(m) for _, m in children)
+    nested = [('classifier.' + name, m) for name, m in model.classifier.named_modules()
+              if isinstance(m, ASPP) and id(m) not in direct]
+    return children, nested
+
+
+def conv_flops(module, output):
+    """ multiply-adds x2 of a Conv2d forward producing ``output``
+    """
+    kh, kw = module.kernel_size
+    return 2 * output.numel() * (module.in_channels // module.groups) * kh * kw
+
+
+def tensor_bytes(output):
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, dict):
+        output = list(output.values())
+    if isinstance(output, (list, tuple)):
+        return sum(tensor_bytes(x) for x in output)
+    return 0
+
+
+class ModuleStats(object):
+    """Forward time, conv FLOPs and output (activation) size of model.backbone
+    and model.classifier submodules, collected by forward hooks.
+
+    Each module's forward is also wrapped in a ``record_function`` range, so
+    it shows up by name in the profiler trace. CUDA time is measured with
+    events, without synchronizing inside the forward pass.
+    """
+    def __init__(self, model, device):
+        children, nested = profiled_modules(getattr(model, 'module', model))
+        self.modules = children + nested
+        self.nested = set(name for name, _ in nested)  # already part of a parent's time
+        self.cuda = device.type == 'cuda'
+        self.stats = {name: {'calls': 0, 'time': 0.0, 'flops': 0, 'bytes': 0} for name, _ in self.modules}
+        self.pending = []
+        self.handles = []
+
+    def attach(self):
+        for name, module in self.modules:
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._hook(name)))
+            for m in module.modules():
+                if isinstance(m, nn.Conv2d):
+                    self.handles.append(m.register_forward_hook(self._conv_hook(name)))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            scope = torch.profiler.record_function(name)
+            scope.__enter__()
+            if self.cuda:
+                start = torch.cuda.Event(enable_timing=True)
+                start.record()
+            else:
+                start = time.perf_counter()
+            module._profile_scope = (scope, start)
+        return hook
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            scope, start = module._profile_scope
+            del module._profile_scope
+            stats = self.stats[name]
+            if self.cuda:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                self.pending.append((name, start, end))
+            else:
+                stats['time'] += time.perf_counter() - start
+            stats['calls'] += 1
+            stats['bytes'] += tensor_bytes(output)
+            scope.__exit__(None, None, None)
+        return hook
+
+    def _conv_hook(self, name):
+        def hook(module, inputs, output):
+            self.stats[name]['flops'] += conv_flops(module, output)
+        return hook
+
+    def collect(self):
+        """ fold pending CUDA event pairs into the module times
+        """
+        if self.pending:
+            torch.cuda.synchronize()
+            for name, start, end in self.pending:
+                self.stats[name]['time'] += start.elapsed_time(end) / 1000
+            self.pending = []
+
+    def table(self):
+        self.collect()
+        total = sum(s['time'] for name, s in self.stats.items() if name not in self.nested) or 1e-9
+        lines = ["%-36s %6s %10s %7s %10s %12s" % ('module', 'calls', 'ms/call', 'time%', 'GFLOPs', 'act MB/call')]
+        for name, _ in self.modules:
+            s = self.stats[name]
+            calls = max(s['calls'], 1)
+            lines.append("%-36s %6d %10.2f %6.1f%% %10.2f %12.1f" % (
+                name, s['calls'], 1000 * s['time'] / calls, 100 * s['time'] / total,
+                s['flops'] / calls / 1e9, s['bytes'] / calls / 2**20))
+        return '\n'.join(lines)
+
+
+class StepProfiler(object):
+    """Run the PyTorch profiler and ModuleStats over iterations A to B-1 of a
+    loop, given as --profile_steps A:B.
+
+    ``step(i)`` is called at the start of iteration ``i``; profiling starts
+    at A and, at B (or on ``close``), the Chrome trace is written to
+    ``<output_dir>/<tag>_trace.json`` and the module table printed. Only
+    the first A:B window of a run is profiled.
+    """
+    def __init__(self, model, device, steps, output_dir, tag='train'):
+        self.start, self.stop = parse_steps(steps)
+        self.device = device
+        self.output_dir = output_dir
+        self.tag = tag
+        self.stats = ModuleStats(model, device)
+        self.profiler = None
+        self.done = False
+
+    def step(self, i):
+        if self.profiler is None and not self.done and self.start <= i < self.stop:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                   profile_memory=True, with_flops=True)
+            self.profiler.__enter__()
+            self.stats.attach()
+        elif self.profiler is not None and i >= self.stop:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        profiler, self.profiler, self.done = self.profiler, None, True
+        self.stats.detach()
+        self.stats.collect()
+        profiler.__exit__(None, None, None)
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, '%s_trace.json' % self.tag)
+        profiler.export_chrome_trace(path)
+        print("Profile of %s iterations %d:%d, trace saved as %s" % (self.tag, self.start, self.stop, path))
+        print(self.stats.table())
@@ -0,0 +1,122 @@
+import copy
+import io
+import json
+import time
+
+import torch
+from torch.utils import data
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from main import (get_argparser, get_dataset, build_model, load_ckpt, load_class_map, head_classes,
+                  prediction_lut, DeviceSegMetrics, DATASET_CLASSES)
+
+
+def get_quant_argparser():
+    parser = get_argparser()
+    parser.description = "Static INT8 post-training quantization of a checkpoint"
+    parser.add_argument("--calib_batches", type=int, default=32,
+                        help="val_loader batches used to calibrate activation ranges (default: 32)")
+    parser.add_argument("--eval_batches", type=int, default=None,
+                        help="val_loader batches to evaluate fp32 and int8 on (default: all)")
+    parser.add_argument("--quant_backend", type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help="quantized kernel backend, qnnpack for ARM (default: x86)")
+    parser.add_argument("--skip_modules", type=str, nargs='*', default=[],
+                        help="module names kept in fp32, e.g. classifier.aspp classifier.project")
+    parser.add_argument("--quant_output", type=str, default='checkpoints/int8_model.pt',
+                        help="where to save the TorchScript INT8 model")
+    parser.add_argument("--quant_report", type=str, default=None,
+                        help="also write the fp32 vs int8 report to this JSON file")
+    return parser
+
+
+def model_size_mb(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2**20
+
+
+def evaluate(model, loader, num_classes, max_batches=None, pred_lut=None):
+    """ segmentation scores and mean latency per image of a CPU model
+    """
+    metrics = DeviceSegMetrics(num_classes)
+    elapsed, count = 0.0, 0
+    with torch.no_grad():
+        for i, (images, labels) in enumerate(loader):
+            if max_batches is not None and i >= max_batches:
+                break
+            images = images.to(dtype=torch.float32)
+            start = time.perf_counter()
+            outputs = model(images)
+            elapsed += time.perf_counter() - start
+            count += images.size(0)
+            preds = outputs.max(dim=1)[1]
+            if pred_lut is not None:
+                preds = pred_lut[preds]
+            metrics.update(labels.long(), preds)
+    return metrics.get_results(), 1000 * elapsed / max(count, 1)
+
+
+def main():
+    opts = get_quant_argparser().parse_args()
+    opts.num_classes = DATASET_CLASSES[opts.dataset.lower()]
+    if opts.class_map is not None:
+        _, opts.num_classes = load_class_map(opts.class_map)
+    opts.test_only = False
+    if opts.dataset == 'voc' and not opts.crop_val:  # uncropped VOC images differ in size
+        opts.val_batch_size = 1
+    torch.manual_seed(opts.random_seed)
+    torch.backends.quantized.engine = opts.quant_backend
+
+    _, val_dst, _ = get_dataset(opts, splits=('val',))
+    val_loader = data.DataLoader(val_dst, batch_size=opts.val_batch_size, shuffle=False, num_workers=2)
+
+    model = build_model(opts.model, head_classes(opts), opts.output_stride, opts.separable_conv)
+    checkpoint = load_ckpt(opts.ckpt)
+    model.load_state_dict(checkpoint["model_state"])
+    del checkpoint
+    model.eval()
+
+    qconfig_mapping = get_default_qconfig_mapping(opts.quant_backend)
+    for name in opts.skip_modules:  # sensitive layers stay fp32
+        qconfig_mapping.set_module_name(name, None)
+    example_inputs = (next(iter(val_loader))[0].to(dtype=torch.float32),)
+    prepared = prepare_fx(copy.deepcopy(model), qconfig_mapping, example_inputs)
+
+    print("Calibrating on %d batches..." % opts.calib_batches)
+    with torch.no_grad():
+        for i, (images, _) in enumerate(val_loader):
+            if i >= opts.calib_batches:
+                break
+            prepared(images.to(dtype=torch.float32))
+    quantized = convert_fx(prepared)
+
+    pred_lut = prediction_lut(opts, torch.device('cpu'))
+    fp32_score, fp32_ms = evaluate(model, val_loader, opts.num_classes, opts.eval_batches, pred_lut)
+    int8_score, int8_ms = evaluate(quantized, val_loader, opts.num_classes, opts.eval_batches, pred_lut)
+    report = {
+        'model': opts.model, 'backend': opts.quant_backend, 'skip_modules': opts.skip_modules,
+        'calib_batches': opts.calib_batches,
+        'fp32': {'Mean IoU': fp32_score['Mean IoU'], 'Overall Acc': fp32_score['Overall Acc'],
+                 'latency_ms': fp32_ms, 'size_mb': model_size_mb(model)},
+        'int8': {'Mean IoU': int8_score['Mean IoU'], 'Overall Acc': int8_score['Overall Acc'],
+                 'latency_ms': int8_ms, 'size_mb': model_size_mb(quantized)},
+    }
+    report['mIoU_delta'] = report['int8']['Mean IoU'] - report['fp32']['Mean IoU']
+
+    print("%-6s %10s %12s %12s %10s" % ('', 'Mean IoU', 'Overall Acc', 'ms/image', 'size MB'))
+    for key in ('fp32', 'int8'):
+        r = report[key]
+        print("%-6s %10.4f %12.4f %12.1f %10.1f" %
+              (key, r['Mean IoU'], r['Overall Acc'], r['latency_ms'], r['size_mb']))
+    print("mIoU delta: %+.4f, speedup: %.2fx" % (report['mIoU_delta'], fp32_ms / max(int8_ms, 1e-9)))
+
+    torch.jit.save(torch.jit.script(quantized), opts.quant_output)
+    print("INT8 model saved as %s" % opts.quant_output)
+    if opts.quant_report is not None:
+        with open(opts.quant_report, 'w') as f:
+            json.dump(report, f, indent=2, default=float)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Segment images with an artifact written by export.py.
+
+Only NumPy, PIL and the runtime of the artifact (torch for model.pt,
+onnxruntime for model.onnx) are imported; none of the training code is.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="model.pt or model.onnx written by export.py")
+    parser.add_argument("--input", type=str, required=True,
+                        help="image file or directory of images")
+    parser.add_argument("--output_dir", type=str, default='./results/',
+                        help="where to write class maps as <name>.png")
+    parser.add_argument("--meta", type=str, default=None,
+                        help="model.json written by export.py (default: next to --model_path)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="intra-op threads of the runtime")
+    return parser
+
+
+class Segmenter(object):
+    """Run an exported model on uint8 RGB images, returning uint8 class maps"""
+    def __init__(self, model_path, meta_path=None, threads=None):
+        meta_path = meta_path or os.path.join(os.path.dirname(model_path), 'model.json')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        self.mean = np.array(meta['mean'], dtype=np.float32).reshape(3, 1, 1)
+        self.std = np.array(meta['std'], dtype=np.float32).reshape(3, 1, 1)
+
+        if model_path.endswith('.onnx'):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            self._run = lambda x: session.run(None, {'image': x})[0]
+        else:
+            import torch
+            if threads:
+                torch.set_num_threads(threads)
+            module = torch.jit.load(model_path, map_location='cpu')
+
+            def run(x):
+                with torch.no_grad():
+                    return module(torch.from_numpy(x)).numpy()
+            self._run = run
+
+    def preprocess(self, image):
+        x = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255.
+        return ((x - self.mean) / self.std)[None]
+
+    def __call__(self, image):
+        logits = self._run(np.ascontiguousarray(self.preprocess(image)))
+        return logits[0].argmax(0).astype(np.uint8)
+
+
+def main():
+    opts = get_argparser().parse_args()
+    if os.path.isdir(opts.input):
+        paths = sorted(os.path.join(opts.input, x) for x in os.listdir(opts.input)
+                       if x.lower().endswith(IMG_EXTENSIONS))
+    else:
+        paths = [opts.input]
+    os.makedirs(opts.output_dir, exist_ok=True)
+
+    segmenter = Segmenter(opts.model_path, opts.meta, opts.threads)
+    for path in paths:
+        pred = segmenter(Image.open(path).convert('RGB'))
+        name = os.path.splitext(os.path.basename(path))[0]
+        Image.fromarray(pred).save(os.path.join(opts.output_dir, name + '.png'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff', '.webp')
+_DONE = object()  # end-of-stream marker passed down the queues
+
+
+def video_frames(path, stop):
+    """ (name, RGB uint8 frame) of a video file, decoded with OpenCV
+    """
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("Streaming from a video file needs OpenCV (pip install opencv-python)")
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError("Cannot open video %s" % path)
+    index = 0
+    try:
+        while not stop.is_set():
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield 'frame_%06d' % index, np.ascontiguousarray(frame[:, :, ::-1])
+            index += 1
+    finally:
+        cap.release()
+
+
+def directory_frames(root, stop, poll=1.0, idle_timeout=None):
+    """(name, RGB uint8 image) of a directory in name order, following files
+    added while running. A file is read once its size is the same on two
+    consecutive polls, so half-written files are skipped. Ends after
+    ``idle_timeout`` seconds without new files, or never if it is None.
+    """
+    seen, sizes = set(), {}
+    idle_since = time.perf_counter()
+    while not stop.is_set():
+        ready = []
+        for name in sorted(os.listdir(root)):
+            if name in seen or not name.lower().endswith(IMG_EXTENSIONS):
+                continue
+            size = os.path.getsize(os.path.join(root, name))
+            if sizes.get(name) == size:
+                ready.append(name)
+            sizes[name] = size
+        for name in ready:
+            seen.add(name)
+            del sizes[name]
+            img = np.asarray(Image.open(os.path.join(root, name)).convert('RGB'))
+            yield os.path.splitext(name)[0], img
+        if ready:
+            idle_since = time.perf_counter()
+        elif idle_timeout is not None and time.perf_counter() - idle_since > idle_timeout:
+            return
+        else:
+            time.sleep(poll)
+
+
+class StreamPipeline(object):
+    """Overlapped streaming inference: decode -> preprocess -> model -> write.
+
+    Decode, preprocess and the ``num_writers`` PNG writers run on their own
+    threads, the model on the calling thread; stages are connected by queues
+    of ``queue_size`` items, so a slow stage blocks the ones before it
+    (backpressure) instead of letting frames pile up in memory. Consecutive
+    frames of the same size are batched up to ``batch_size``.
+
+    Args:
+        frames: callable taking a stop Event, yielding (name, RGB uint8 array).
+        segment: callable mapping a normalized NxCxHxW batch on ``device`` to
+            a NxHxW tensor of class ids.
+        overlay: optional callable mapping (frame, class ids) to an RGB uint8
+            image written as ``<name>_overlay.png``.
+    """
+    def __init__(self, frames, segment, out_dir, device, batch_size=4, queue_size=8, num_writers=2,
+                 overlay=None, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), report_every=5.0):
+        self.frames = frames
+        self.segment = segment
+        self.out_dir = out_dir
+        self.device = device
+        self.batch_size = batch_size
+        self.num_writers = num_writers
+        self.overlay = overlay
+        self.mean = torch.tensor(mean).view(3, 1, 1)
+        self.std = torch.tensor(std).view(3, 1, 1)
+        self.report_every = report_every
+        self.queues = {name: queue.Queue(maxsize=queue_size) for name in ('decoded', 'ready', 'predicted')}
+        self.stop = threading.Event()
+        self.errors = []
+        self.written = 0
+        self.written_lock = threading.Lock()  # num_writers threads count frames
+        self.pinned = None
+
+    def _fail(self, e):
+        self.errors.append(e)
+        self.stop.set()
+
+    def _decode(self):
+        try:
+            for item in self.frames(self.stop):
+                self.queues['decoded'].put(item)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self.queues['decoded'].put(_DONE)
+
+    def _stage(self, fn, src, dst=None):
+        """ apply fn to items of src until _DONE; after a failure only drain src
+        """
+        while True:
+            item = src.get()
+            if item is _DONE:
+                break
+            if self.stop.is_set():
+                continue
+            try:
+                out = fn(item)
+                if dst is not None:
+                    dst.put(out)
+            except BaseException as e:
+                self._fail(e)
+        if dst is not None:
+            dst.put(_DONE)
+
+    def _preprocess(self, item):
+        name, frame = item
+        x = torch.from_numpy(frame).permute(2, 0, 1).float().div_(255)
+        x = (x - self.mean) / self.std
+        return name, frame, x
+
+    def _stack(self, xs):
+        """ batch of CHW tensors, stacked into a reused pinned buffer for CUDA;
+        segment(...).cpu() waits for the copy out of it before the next batch
+        """
+        if self.device.type != 'cuda':
+            return torch.stack(xs)
+        shape = (self.batch_size,) + tuple(xs[0].shape)
+        if self.pinned is None or self.pinned.shape != shape:
+            self.pinned = torch.empty(shape).pin_memory()
+        return torch.stack(xs, out=self.pinned[:len(xs)])
+
+    def _write(self, item):
+        name, frame, pred = item
+        Image.fromarray(pred).save(os.path.join(self.out_dir, name + '.png'))
+        if self.overlay is not None:
+            Image.fromarray(self.overlay(frame, pred)).save(os.path.join(self.out_dir, name + '_overlay.png'))
+        with self.written_lock:
+            self.written += 1
+
+    def _report(self, start):
+        elapsed = time.perf_counter() - start
+        depths = ', '.join('%s %d/%d' % (name, q.qsize(), q.maxsize) for name, q in self.queues.items())
+        print("[stream] %d frames, %.1f fps, queues: %s" % (self.written, self.written / max(elapsed, 1e-9), depths))
+
+    def run(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        ready, predicted = self.queues['ready'], self.queues['predicted']
+        threads = [threading.Thread(target=self._decode),
+                   threading.Thread(target=self._stage, args=(self._preprocess, self.queues['decoded'], ready))]
+        threads += [threading.Thread(target=self._stage, args=(self._write, predicted))
+                    for _ in range(self.num_writers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        start = last_report = time.perf_counter()
+        pending = None
+        while True:
+            item = pending if pending is not None else ready.get()
+            pending = None
+            if item is _DONE:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    nxt = ready.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _DONE or nxt[2].shape != item[2].shape:
+                    pending = nxt
+                    break
+                batch.append(nxt)
+            if not self.stop.is_set():
+                try:
+                    images = self._stack([x for _, _, x in batch]).to(self.device, non_blocking=True)
+                    preds = self.segment(images).cpu().numpy().astype(np.uint8)
+                    for (name, frame, _), pred in zip(batch, preds):
+                        predicted.put((name, frame, pred))
+                except BaseException as e:
+                    self._fail(e)
+            if time.perf_counter() - last_report >= self.report_every:
+                self._report(start)
+                last_report = time.perf_counter()
+        for _ in range(self.num_writers):
+            predicted.put(_DONE)
+        for t in threads:
+            t.join()
+        self._report(start)
+        if self.errors:
+            raise self.errors[0]
+        return self.written
+
+
+def run_stream(opts, segment, device, overlay=None):
+    """ stream --stream (a video file or a growing image directory) through the model
+    """
+    if os.path.isdir(opts.stream):
+        def frames(stop):
+            return directory_frames(opts.stream, stop, poll=opts.stream_poll, idle_timeout=opts.stream_idle_timeout)
+    else:
+        def frames(stop):
+            return video_frames(opts.stream, stop)
+    pipeline = StreamPipeline(frames, segment, opts.save_val_results_path, device,
+                              batch_size=opts.val_batch_size, queue_size=opts.stream_queue,
+                              num_writers=opts.save_workers, overlay=overlay)
+    return pipeline.run()